@@ -0,0 +1,175 @@
+from contextlib import redirect_stdout
+from getopt import getopt, GetoptError
+from io import StringIO
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from timeit import Timer
+import json
+import os
+import sys
+from .fake_serial import FakeSerial
+from .programmer import Programmer
+from .main import main as eeprom_main
+from .transcript import RX, read_transcript
+from .verify import diff_ranges, summarise
+from .writer import EEPROM, AsciiProtocol, BinaryProtocol, address_field, data_field, decode_record
+
+RECSIZE = 16
+RECORD = bytes(range(0x30, 0x30 + RECSIZE))
+RESPONSE = b'1230:' + data_field(RECORD).encode() + b'\r\n'
+IMAGE = bytes(range(256)) * 32
+PATCHED = IMAGE[:1000] + b'\x00' * 24 + IMAGE[1024:4000] + b'\x01' + IMAGE[4001:]
+OPERATIONS = ("read", "write", "verify", "dump")
+
+MICRO_BENCHMARKS = [
+    ("address_field", lambda: address_field(0x1230)),
+    ("data_field", lambda: data_field(RECORD)),
+    ("ascii_write_cmd", lambda: AsciiProtocol().write_cmd(0x1230, RECORD)),
+    ("binary_write_cmd", lambda: BinaryProtocol().write_cmd(0x1230, RECORD)),
+    ("decode_record", lambda: decode_record(0x1230, RESPONSE)),
+    ("compile_writes_8k", lambda: list(EEPROM().compile_writes((addr, IMAGE[addr:addr + RECSIZE]) for addr in range(0, len(IMAGE), RECSIZE)))),
+    ("diff_ranges_8k", lambda: diff_ranges(0, IMAGE, PATCHED)),
+    ("summarise_8k", lambda: summarise(diff_ranges(0, IMAGE, PATCHED), len(IMAGE))),
+]
+
+def result(name, count, seconds, unit):
+    return {"name": name, "count": count, "seconds": seconds,
+            "us_per_" + unit: seconds * 1e6 / count}
+
+def micro_benchmarks():
+    results = []
+    for name, func in MICRO_BENCHMARKS:
+        count, seconds = Timer(func).autorange()
+        results.append(result(name, count, seconds, "op"))
+    return results
+
+def emulator(rom_size, baudrate):
+    with redirect_stdout(StringIO()):
+        return FakeSerial(baudrate=baudrate or 115200, throttle=baudrate is not None,
+                          rom_size=rom_size, timeout=0.1)
+
+def end_to_end(operation, size_k, baudrate, workdir):
+    rom_size = size_k * 1024
+    image = (IMAGE * (rom_size // len(IMAGE) + 1))[:rom_size]
+    rom_file = os.path.join(workdir, "image.rom")
+    with open(rom_file, 'wb') as output:
+        output.write(image)
+    port = emulator(rom_size, baudrate)
+    if operation == "verify":
+        port.memory[:] = image
+    eeprom = EEPROM(rom_size)
+    eeprom.open_port(port)
+    programmer = Programmer(eeprom, StringIO())
+    programmer.set_start(0)
+    programmer.set_end(rom_size)
+    if operation in ("write", "verify"):
+        programmer.set_input_rom(rom_file)
+        programmer.set_verify(operation == "verify")
+    elif operation == "dump":
+        programmer.set_dump_file(os.path.join(workdir, "dump.rom"))
+
+    started = perf_counter()
+    if operation == "write":
+        programmer.write_eeprom()
+    else:
+        programmer.read_eeprom()
+    seconds = perf_counter() - started
+
+    name = "{}_{}k_{}".format(operation, size_k, baudrate or "unthrottled")
+    return result(name, rom_size // RECSIZE, seconds, "record")
+
+def end_to_end_benchmarks(sizes, baudrates, operations=OPERATIONS):
+    results = []
+    with TemporaryDirectory() as workdir:
+        for baudrate in baudrates:
+            for size_k in sizes:
+                for operation in operations:
+                    results.append(end_to_end(operation, size_k, baudrate, workdir))
+    return results
+
+def replay_benchmark(transcript):
+    # Re-runs the recorded command line against the transcript with no
+    # waiting, so what's left is the host's own time for the session.
+    meta, events = read_transcript(transcript)
+    # Options first, as getopt stops at the recorded rom file
+    args = ["", "--replay", transcript, "--replay-speed", "0"] + meta.get("args", [])
+    cwd = os.getcwd()
+    started = perf_counter()
+    try:
+        os.chdir(meta.get("cwd", cwd))
+        with redirect_stdout(StringIO()):
+            eeprom_main(StringIO(), args)
+    except SystemExit:
+        pass
+    finally:
+        os.chdir(cwd)
+    seconds = perf_counter() - started
+    name = "replay_" + os.path.splitext(os.path.basename(transcript))[0]
+    return result(name, max(1, sum(1 for event in events if event[0] == RX)), seconds, "op")
+
+def print_results(results, outstream, baseline=None):
+    previous = {entry["name"]: entry for entry in baseline or []}
+    for entry in results:
+        unit = "us_per_op" if "us_per_op" in entry else "us_per_record"
+        line = "{:<32} {:>12.2f} us/{}".format(entry["name"], entry[unit], unit.split("_")[-1])
+        if entry["name"] in previous and unit in previous[entry["name"]]:
+            line += "  ({:+.1f}%)".format((entry[unit] / previous[entry["name"]][unit] - 1) * 100)
+        print(line, file=outstream)
+
+def usage(out, err):
+    print(err, file=out)
+    print("Usage: python -m eeprom.benchmark [-m] [-e] [-S sizes] [-B rates] [-o file] [-c file] [-t file]", file=out)
+    print("Where:", file=out)
+    print("    -m - only run the microbenchmarks", file=out)
+    print("    -e - only run the end-to-end benchmarks", file=out)
+    print("    -S - comma separated EEPROM sizes in K (default is 8,32,64)", file=out)
+    print("    -B - comma separated line rates, none for unthrottled (default is none,1000000)", file=out)
+    print("    -o - write results as JSON to file", file=out)
+    print("    -c - compare against JSON results from an earlier run", file=out)
+    print("    -t - replay a serial transcript recorded with --record, repeat for more", file=out)
+    exit(-1)
+
+def main(outstream, args):
+    micro, e2e = True, True
+    sizes, baudrates = [8, 32, 64], [None, 1000000]
+    output_file, baseline_file = None, None
+    transcripts = []
+    try:
+        opts, _ = getopt(args[1:], "meS:B:o:c:t:")
+        for o, a in opts:
+            if o == "-m":
+                e2e = False
+            elif o == "-e":
+                micro = False
+            elif o == "-S":
+                sizes = [int(size) for size in a.split(",")]
+            elif o == "-B":
+                baudrates = [None if rate == "none" else int(rate) for rate in a.split(",")]
+            elif o == "-o":
+                output_file = a
+            elif o == "-c":
+                baseline_file = a
+            elif o == "-t":
+                transcripts.append(a)
+    except (GetoptError, ValueError) as err:
+        usage(outstream, err)
+
+    baseline = None
+    if baseline_file:
+        with open(baseline_file) as previous:
+            baseline = json.load(previous)
+
+    results = []
+    if micro:
+        results += micro_benchmarks()
+    if e2e:
+        results += end_to_end_benchmarks(sizes, baudrates)
+    results += [replay_benchmark(transcript) for transcript in transcripts]
+    print_results(results, outstream, baseline)
+    if output_file:
+        with open(output_file, 'w') as output:
+            json.dump(results, output, indent=2)
+    return results
+
+if __name__ == "__main__":
+    main(sys.stdout, sys.argv)
@@ -0,0 +1,134 @@
+from queue import Queue
+from threading import Event, Thread
+import json
+import os
+import socket
+import socketserver
+
+STATUS_PREFIX = "#EXIT "
+
+class DaemonRunning(Exception):
+    pass
+
+class SocketStream():
+    # Text stream for a client connection; a client that hangs up mid-job
+    # shouldn't abort the job, so writes to a closed socket are dropped.
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.connected = True
+
+    def write(self, text):
+        if self.connected:
+            try:
+                self.wfile.write(text.encode())
+            except OSError:
+                self.connected = False
+        return len(text)
+
+    def flush(self):
+        pass
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Another daemon checking whether this one is still alive
+            return
+        job = json.loads(line)
+        stream = SocketStream(self.wfile)
+        if self.server.jobs.qsize() or self.server.busy:
+            print("Queued behind {} job(s).".format(self.server.jobs.qsize() + self.server.busy), file=stream)
+        done = Event()
+        self.server.jobs.put((job, stream, done))
+        done.wait()
+
+class JobServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, execute):
+        if os.path.exists(socket_path):
+            if listening(socket_path):
+                raise DaemonRunning("A daemon is already serving jobs on {}.".format(socket_path))
+            # Left behind by a daemon that didn't shut down cleanly
+            os.remove(socket_path)
+        super().__init__(socket_path, JobHandler)
+        self.socket_path = socket_path
+        self.execute = execute
+        self.jobs = Queue()
+        self.busy = 0
+        Thread(target=self.work, daemon=True).start()
+
+    def work(self):
+        # One worker, so jobs reach the programmer strictly in arrival order
+        while True:
+            job, stream, done = self.jobs.get()
+            self.busy = 1
+            try:
+                code = run_job(self.execute, job, stream)
+            finally:
+                self.busy = 0
+            print(STATUS_PREFIX + str(code), file=stream)
+            done.set()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+def listening(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+def run_job(execute, job, stream):
+    try:
+        execute(job["args"], job["cwd"], stream)
+    except SystemExit as err:
+        if isinstance(err.code, str):
+            print(err.code, file=stream)
+            return 1
+        return err.code or 0
+    except Exception as err:
+        print(err, file=stream)
+        return -4
+    return 0
+
+def serve(socket_path, execute, outstream):
+    server = JobServer(socket_path, execute)
+    print("Serving jobs on {}.".format(socket_path), file=outstream)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def submit(socket_path, args, outstream):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps({"args": args, "cwd": os.getcwd()}) + "\n").encode())
+        for line in client.makefile():
+            if line.startswith(STATUS_PREFIX):
+                return int(line[len(STATUS_PREFIX):])
+            outstream.write(line)
+    print("Lost connection to the programmer daemon.", file=outstream)
+    return -2
+
+def client_args(args):
+    # The job is replayed on the daemon, so drop the option that sent it there
+    return without_option(args, "--socket")
+
+def without_option(args, option):
+    result = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + "="):
+            result.append(arg)
+    return result
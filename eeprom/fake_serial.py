@@ -1,9 +1,18 @@
+from collections import deque
+from time import monotonic, sleep
+from zlib import crc32
+from .writer import OK, ACK, checksum, data_field
+
+BITS_PER_BYTE = 10
+
 class FakeSerial:
+    VERSION = b'EEPROM EMULATOR +BIN +CRC +EXT\r\n'
+
     def __init__( self, port=None, baudrate = 19200, timeout=1,
                   bytesize = 8, parity = 'N', stopbits = 1, xonxoff=0,
-                  rtscts = 0):
+                  rtscts = 0, rom_size=65536, throttle=False, latency=0.0,
+                  write_latency=0.0, drop_ok=(), bad_checksum=()):
         print("Port is ", port)
-        self.halfduplex = True
         self.name     = port
         self.port     = port
         self.timeout  = timeout
@@ -13,22 +22,134 @@ class FakeSerial:
         self.stopbits = stopbits
         self.xonxoff  = xonxoff
         self.rtscts   = rtscts
-        self._data = b'0000:FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF,00\r\n'
+        self.memory = bytearray(b'\xff' * rom_size)
+        self.throttle = throttle
+        self.latency = latency
+        self.write_latency = write_latency
+        self.drop_ok = set(drop_ok)
+        self.bad_checksum = set(bad_checksum)
+        self.commands = 0
+        self._pending = b''
+        self._responses = deque()
+        self._line_free = 0.0
+        self._device_free = 0.0
         if isinstance(self.port, str):
             self.port = open(self.port, "wb+")
 
     def close(self):
         pass
-    
+
     def flush(self):
-        self.port.flush()
+        if self.port:
+            self.port.flush()
 
     def write(self, data):
-        written = self.port.write(data)
-        return written
+        if self.port:
+            self.port.write(data)
+        self._line_free = max(self._line_free, monotonic()) + self._line_time(len(data))
+        self._pending += data
+        self._execute()
+        return len(data)
 
     def readline(self):
-        self.halfduplex = not self.halfduplex
-        if self.halfduplex:
-            return b"OK\r\n"
-        return self._data
\ No newline at end of file
+        return self._receive(lambda received: received.find(b'\n') + 1)
+
+    def read(self, size=1):
+        return self._receive(lambda received: size if len(received) >= size else 0)
+
+    def reset_input_buffer(self):
+        self._responses.clear()
+
+    def _line_time(self, size):
+        if not self.throttle:
+            return 0.0
+        return size * BITS_PER_BYTE / self.baudrate
+
+    def _receive(self, complete):
+        # Hand back bytes as they would have arrived on the wire, giving up
+        # with whatever came in if the port timeout passes first.
+        received = b''
+        give_up = monotonic() + self.timeout
+        while self._responses:
+            ready, chunk = self._responses[0]
+            wait = ready - monotonic()
+            if wait > 0:
+                if monotonic() + wait > give_up:
+                    sleep(max(0.0, give_up - monotonic()))
+                    break
+                sleep(wait)
+            self._responses.popleft()
+            received += chunk
+            size = complete(received)
+            if size:
+                if size < len(received):
+                    self._responses.appendleft((0.0, received[size:]))
+                return received[:size]
+        if self.throttle:
+            sleep(max(0.0, give_up - monotonic()))
+        return received
+
+    def _respond(self, response, busy=0.0):
+        arrived = self._line_free
+        done = max(arrived, self._device_free) + busy
+        self._device_free = done
+        if response:
+            ready = done + self.latency + self._line_time(len(response))
+            self._responses.append((ready if self.throttle else 0.0, response))
+
+    def _store(self, addr, data):
+        data = data[:len(self.memory) - addr]
+        self.memory[addr:addr + len(data)] = data
+
+    def _acknowledge(self, ok):
+        if self.commands in self.drop_ok:
+            return b''
+        return ok
+
+    def _execute(self):
+        while self._pending:
+            if self._pending[:1] in (b'r', b'w'):
+                if len(self._pending) < 2:
+                    return
+                size = 5 + (self._pending[1] if self._pending[:1] == b'w' else 0)
+                if len(self._pending) < size:
+                    return
+                command, self._pending = self._pending[:size], self._pending[size:]
+                self.commands += 1
+                self._respond(*self._binary(command))
+            else:
+                if b'\n' not in self._pending:
+                    return
+                line, self._pending = self._pending.split(b'\n', 1)
+                self.commands += 1
+                self._respond(*self._ascii(line))
+
+    def _ascii(self, line):
+        if line.startswith(b'V'):
+            return self.VERSION, 0.0
+        if line.startswith(b'C'):
+            first, last = (int(address, 16) for address in line[1:].split(b'-'))
+            return b'%s:%08X\r\n' % (line[1:], crc32(self.memory[first:last + 1])), 0.0
+        # Four digit addresses, or six once the host has switched to 24-bit addressing
+        address = line[1:].split(b':')[0]
+        addr = int(address, 16) % len(self.memory)
+        if line.startswith(b'W'):
+            data = line[len(address) + 2:len(address) + 34]
+            self._store(addr, bytes.fromhex(data.decode()))
+            return self._acknowledge(OK), self.write_latency
+        record = data_field(self.memory[addr:addr + 16])
+        if self.commands in self.bad_checksum:
+            record = record[:-2] + "%02X" % (int(record[-2:], 16) ^ 0xff)
+        return address + b':' + record.encode() + b'\r\n' + self._acknowledge(OK), 0.0
+
+    def _binary(self, command):
+        length = command[1]
+        addr = int.from_bytes(command[2:4], 'big') % len(self.memory)
+        if command[:1] == b'w':
+            self._store(addr, command[4:4 + length])
+            return self._acknowledge(ACK), self.write_latency
+        body = bytes([length]) + command[2:4] + bytes(self.memory[addr:addr + length])
+        chksum = checksum(body)
+        if self.commands in self.bad_checksum:
+            chksum ^= 0xff
+        return body + bytes([chksum]) + self._acknowledge(ACK), 0.0
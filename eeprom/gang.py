@@ -0,0 +1,49 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from time import perf_counter
+from .writer import EEPROMException
+
+GangResult = namedtuple("GangResult", ["port", "passed", "seconds", "error", "log"])
+
+def port_name(port):
+    return getattr(port, "name", port)
+
+def program_device(port, setup, task):
+    log = StringIO()
+    started = perf_counter()
+    error = None
+    programmer = None
+    try:
+        programmer = setup(port, log)
+        task(programmer)
+        if programmer.differences:
+            error = "verify failed"
+    except EEPROMException as err:
+        error = str(err)
+    except SystemExit as err:
+        # Programmer still bails out with exit() on bad input; keep it to this device
+        lines = log.getvalue().splitlines()
+        error = err.code if isinstance(err.code, str) else (lines[-1] if lines else "aborted")
+    finally:
+        if programmer:
+            programmer.programmer.close()
+    return GangResult(port_name(port), error is None, perf_counter() - started, error, log.getvalue())
+
+def gang_program(ports, setup, task):
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        return list(pool.map(lambda port: program_device(port, setup, task), ports))
+
+def print_report(results, outstream):
+    print("Gang results:", file=outstream)
+    for result in results:
+        status = "PASS" if result.passed else "FAIL"
+        line = "{}: {} in {:.2f}s".format(result.port, status, result.seconds)
+        if result.error:
+            line += " ({})".format(result.error.strip())
+        print(line, file=outstream)
+        # Each device's own output, so stats and verify details aren't lost
+        for log_line in result.log.splitlines():
+            print("\t" + log_line, file=outstream)
+    passed = sum(1 for result in results if result.passed)
+    print("{} of {} devices passed.".format(passed, len(results)), file=outstream)
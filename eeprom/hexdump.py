@@ -0,0 +1,27 @@
+# Lookup tables so each line is rendered with a couple of joins rather than
+# formatting every byte.
+HEX_BYTES = ["%02x " % value for value in range(256)]
+PRINTABLE = bytes(value if 0x20 <= value < 0x7f else ord(".") for value in range(256))
+HEX_WIDTH = 50
+
+def hexdump_line(address, record):
+    hex_field = "".join(map(HEX_BYTES.__getitem__, record[:8])) + " " + "".join(map(HEX_BYTES.__getitem__, record[8:]))
+    return "{:08x}  {:<{}}|{}|".format(address, hex_field, HEX_WIDTH, bytes(record).translate(PRINTABLE).decode("ascii"))
+
+def hexdump_lines(records):
+    # Same layout as hexdump -C, including '*' for runs of repeated lines
+    previous = None
+    squeezed = False
+    end = None
+    for address, record in records:
+        end = address + len(record)
+        if record == previous:
+            if not squeezed:
+                squeezed = True
+                yield "*"
+            continue
+        previous = record
+        squeezed = False
+        yield hexdump_line(address, record)
+    if end is not None:
+        yield "{:08x}".format(end)
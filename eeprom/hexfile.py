@@ -0,0 +1,79 @@
+import os
+
+INTEL_HEX_EXTENSIONS = (".hex", ".ihx", ".ihex")
+SRECORD_EXTENSIONS = (".s19", ".s28", ".s37", ".srec", ".mot")
+SRECORD_ADDRESS_BYTES = {"1": 2, "2": 3, "3": 4}
+
+class ImageFormatError(ValueError):
+    pass
+
+def image_format(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in INTEL_HEX_EXTENSIONS:
+        return "ihex"
+    if extension in SRECORD_EXTENSIONS:
+        return "srec"
+    return None
+
+def load_segments(filename):
+    loader = read_intel_hex if image_format(filename) == "ihex" else read_srecord
+    with open(filename) as image:
+        return merge_segments(loader(image))
+
+def merge_segments(chunks):
+    segments = []
+    for address, data in sorted(chunks, key=lambda chunk: chunk[0]):
+        if segments and segments[-1][0] + len(segments[-1][1]) == address:
+            segments[-1][1].extend(data)
+        else:
+            segments.append((address, bytearray(data)))
+    return [(address, bytes(data)) for address, data in segments]
+
+def hex_bytes(line, line_number):
+    try:
+        return bytes.fromhex(line)
+    except ValueError:
+        raise ImageFormatError("Line {} is not valid hex.".format(line_number))
+
+def read_intel_hex(lines):
+    base = 0
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(":"):
+            raise ImageFormatError("Line {} doesn't start with ':'.".format(line_number))
+        record = hex_bytes(line[1:], line_number)
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ImageFormatError("Line {} has the wrong length.".format(line_number))
+        if sum(record) & 0xff:
+            raise ImageFormatError("Line {} has a bad checksum.".format(line_number))
+        offset = (record[1] << 8) | record[2]
+        kind, data = record[3], record[4:-1]
+        if kind == 0x00:
+            yield base + offset, data
+        elif kind == 0x01:
+            return
+        elif kind == 0x02:
+            base = int.from_bytes(data, 'big') << 4
+        elif kind == 0x04:
+            base = int.from_bytes(data, 'big') << 16
+
+def read_srecord(lines):
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if len(line) < 4 or line[0] != "S":
+            raise ImageFormatError("Line {} isn't an S-record.".format(line_number))
+        record = hex_bytes(line[2:], line_number)
+        if len(record) != record[0] + 1:
+            raise ImageFormatError("Line {} has the wrong length.".format(line_number))
+        if (sum(record[:-1]) & 0xff) ^ 0xff != record[-1]:
+            raise ImageFormatError("Line {} has a bad checksum.".format(line_number))
+        address_bytes = SRECORD_ADDRESS_BYTES.get(line[1])
+        if address_bytes:
+            address = int.from_bytes(record[1:1 + address_bytes], 'big')
+            yield address, record[1 + address_bytes:-1]
+        elif line[1] in "789":
+            return
@@ -0,0 +1,53 @@
+from hashlib import sha256
+import json
+import os
+
+SAVE_EVERY_RECORDS = 16
+
+class Journal():
+    def __init__(self, filename, image, version, start, end, ranges=None):
+        self.filename = filename
+        self.entry = {
+            "image_sha256": sha256(image).hexdigest(),
+            "version": version,
+            "start": start,
+            "end": end,
+            "ranges": [list(address_range) for address_range in ranges] if ranges else None,
+            "confirmed": start
+        }
+        self.unsaved = 0
+        self.enabled = True
+
+    def resume_point(self):
+        try:
+            with open(self.filename) as journal:
+                saved = json.load(journal)
+        except (OSError, ValueError):
+            return None
+        for key in ("image_sha256", "version", "start", "end", "ranges"):
+            if saved.get(key) != self.entry[key]:
+                return None
+        return saved.get("confirmed")
+
+    def confirm(self, address):
+        self.entry["confirmed"] = address
+        self.unsaved += 1
+        if self.unsaved >= SAVE_EVERY_RECORDS:
+            self.save()
+
+    def save(self):
+        if not self.enabled:
+            return
+        self.unsaved = 0
+        temp_name = self.filename + ".tmp"
+        try:
+            with open(temp_name, 'w') as journal:
+                json.dump(self.entry, journal)
+            os.replace(temp_name, self.filename)
+        except OSError:
+            # Nowhere to keep the journal; carry on without resume support
+            self.enabled = False
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -9,11 +9,19 @@
 from getopt import getopt, GetoptError
 from enum import IntEnum
 import struct
-from time import sleep
-from .writer import EEPROM, EEPROMException
-from .programmer import Programmer
+from .writer import EEPROMException, EEPROMTimeout, EEPROMUnsupported, DEFAULT_BAUDRATE, DEFAULT_RETRIES, ACK_DEADLINE_IN_SECS, READY_DEADLINE_IN_SECS, RECORD_SIZE
+from .programmer import Programmer, read_rom_from_file
 import sys
+import os
 from .fake_serial import FakeSerial
+from .gang import gang_program, print_report, port_name
+from .stats import Stats, instrument
+from .ranges import parse_ranges, read_range_file, merge_ranges
+from .daemon import DaemonRunning, serve, submit, client_args, without_option
+from .transcript import RecordingPort, ReplaySerial
+from .session import Session
+from .hexfile import ImageFormatError, image_format, load_segments
+from .shadow import ShadowCache, DEFAULT_CACHE_DIR
 
 MODULE_NAME = "eeprom"
 
@@ -25,10 +33,14 @@ class ROMSIZE(IntEnum):
     ROM16K = 16
     ROM32K = 32
     ROM64K = 64
+    ROM128K = 128
+    ROM256K = 256
+    ROM512K = 512
+    ROM1024K = 1024
 
 def usage(out, err):
     print(err, file=out)
-    print("Usage: %s [ -V | -r | -w | -d] [-v] [-s n] [-e n] [-p port] [-S n] rom_file" % (MODULE_NAME), file=out)
+    print("Usage: %s [ -V | -r | -w | -d] [-v] [-s n] [-e n] [-p port] [-S n] [-P n] [-T n] [-A n] [-R n] [-B n] [-b] [--diff-write] [--verify-report file] [--stats | --stats-json] [--resume] [--range s-e,...] [--range-file file] [-C] [--crc-verify] [--blank-check] [--skip-blank] [--chip-id id [--trust-cache] [--cache-dir dir]] [--record file | --replay file [--replay-speed x]] [--daemon socket | --socket socket] rom_file" % (MODULE_NAME), file=out)
     print("Where:", file=out)
     print("    -V - print EEPROM writer firmware version", file=out)
     print("    -r - read EEPROM contents and print as hex (default option)", file=out)
@@ -37,15 +49,41 @@ def usage(out, err):
     print("    -v - verify contents of EEPROM with ROM file (default is False)", file=out)
     print("    -s - start address (default is 0", file=out)
     print("    -e - end address", file=out)
-    print("    -p - USB port tty (default is /dev/tty.usbserial-1420", file=out)
+    print("    -p - USB port tty (default is /dev/tty.usbserial-1420, repeat to gang program)", file=out)
     print("    -S - EEPROM size in K (default is 8)", file=out)
+    print("    -P - number of commands kept in flight (default is 1, no pipelining)", file=out)
+    print("    -T - seconds to wait for the programmer to answer (default is 5)", file=out)
+    print("    -A - seconds to wait for the programmer to acknowledge a command (default is 0.6)", file=out)
+    print("    -R - times to resend a failed command before giving up (default is 5)", file=out)
+    print("    -B - serial baud rate, or auto to probe for the fastest (default is 9600)", file=out)
+    print("    -b - use the binary protocol if the firmware supports it", file=out)
+    print("    -C - print EEPROM contents in hexdump -C format", file=out)
+    print("    --diff-write - only write records that differ from the EEPROM contents", file=out)
+    print("    --verify-report - write a JSON report of verify differences to file", file=out)
+    print("    --stats - print transfer statistics when done", file=out)
+    print("    --stats-json - print transfer statistics as JSON when done", file=out)
+    print("    --resume - continue an interrupted write from its journal", file=out)
+    print("    --range - address ranges to process as start-end, comma separated or repeated", file=out)
+    print("    --range-file - read address ranges from file, one or more per line", file=out)
+    print("    --crc-verify - verify with the programmer's range checksum when the firmware has one", file=out)
+    print("    --blank-check - check the EEPROM is all FF, and don't write to it if not", file=out)
+    print("    --skip-blank - when writing to a blank EEPROM, skip records that are all FF", file=out)
+    print("    --chip-id - keep a shadow copy of the EEPROM with this ID in the cache", file=out)
+    print("    --trust-cache - use the shadow copy instead of reading parts known to match", file=out)
+    print("    --cache-dir - directory for shadow copies (default is ~/.cache/eepromer)", file=out)
+    print("    --record - record everything sent to and read from the programmer in file", file=out)
+    print("    --replay - play a recorded session back instead of using a programmer", file=out)
+    print("    --replay-speed - replay timing scale, 0 for as fast as possible (default is 1)", file=out)
+    print("    --daemon - keep the port open and run jobs sent to the unix socket", file=out)
+    print("    --socket - send this job to the daemon listening on the unix socket", file=out)
     print("    rom_file - ROM file to write or verify against", file=out)
     exit(-1)
 
-def parse_args(outstream, input):
+def parse_args(outstream, input, cwd=""):
     options = {
             "rom_file": None,
             "TTY":  "/dev/tty.usbserial-14110",
+            "ports": [],
             "dump_rom": False,
             "verify_rom": False,
             "start": 0,
@@ -53,13 +91,36 @@ def parse_args(outstream, input):
             "reading": True,
             "version": False,
             "debug": False,
-            "rom_size": int(ROMSIZE.ROM8K)
+            "rom_size": int(ROMSIZE.ROM8K),
+            "window": 1,
+            "ready_deadline": READY_DEADLINE_IN_SECS,
+            "retries": DEFAULT_RETRIES,
+            "ack_deadline": ACK_DEADLINE_IN_SECS,
+            "baudrate": DEFAULT_BAUDRATE,
+            "binary": False,
+            "diff_write": False,
+            "verify_report": None,
+            "stats": None,
+            "resume": False,
+            "ranges": [],
+            "hexdump": False,
+            "crc_verify": False,
+            "blank_check": False,
+            "skip_blank": False,
+            "chip_id": None,
+            "trust_cache": False,
+            "cache_dir": DEFAULT_CACHE_DIR,
+            "record": None,
+            "replay": None,
+            "replay_speed": 1.0,
+            "daemon": None,
+            "socket": None
         }
 
     try:
-        opts, args = getopt(input, "Vrwdvbxs:e:p:S:")
+        opts, args = getopt(input, "VrwdvbCxs:e:p:S:P:T:A:R:B:", ["diff-write", "verify-report=", "stats", "stats-json", "resume", "range=", "range-file=", "crc-verify", "blank-check", "skip-blank", "chip-id=", "trust-cache", "cache-dir=", "record=", "replay=", "replay-speed=", "daemon=", "socket="])
         if len(args) > 0:
-            options["rom_file"] = args.pop(0)
+            options["rom_file"] = os.path.join(cwd, args.pop(0))
     except GetoptError as err:
         usage(outstream, err)
 
@@ -76,10 +137,60 @@ def parse_args(outstream, input):
             options["end"] = int(a)
         elif o == "-p":
             options["TTY"] = a
+            options["ports"].append(a)
         elif o == "-r":
             options["reading"] = True
         elif o == "-w":
             options["reading"] = False
+        elif o == "--diff-write":
+            options["diff_write"] = True
+        elif o == "--verify-report":
+            options["verify_report"] = os.path.join(cwd, a)
+        elif o == "--stats":
+            options["stats"] = "text"
+        elif o == "--stats-json":
+            options["stats"] = "json"
+        elif o == "--resume":
+            options["resume"] = True
+        elif o == "--range":
+            try:
+                options["ranges"].extend(parse_ranges(a))
+            except ValueError as err:
+                usage(outstream, err)
+        elif o == "--range-file":
+            try:
+                options["ranges"].extend(read_range_file(os.path.join(cwd, a)))
+            except ValueError as err:
+                usage(outstream, err)
+        elif o == "--crc-verify":
+            options["crc_verify"] = True
+        elif o == "--blank-check":
+            options["blank_check"] = True
+        elif o == "--skip-blank":
+            options["skip_blank"] = True
+        elif o == "--chip-id":
+            options["chip_id"] = a
+        elif o == "--trust-cache":
+            options["trust_cache"] = True
+        elif o == "--cache-dir":
+            options["cache_dir"] = os.path.join(cwd, a)
+        elif o == "--record":
+            options["record"] = a
+        elif o == "--replay":
+            options["replay"] = a
+        elif o == "--replay-speed":
+            try:
+                options["replay_speed"] = float(a)
+            except ValueError as err:
+                usage(outstream, err)
+        elif o == "--daemon":
+            options["daemon"] = a
+        elif o == "--socket":
+            options["socket"] = a
+        elif o == "-b":
+            options["binary"] = True
+        elif o == "-C":
+            options["hexdump"] = True
         elif o == "-x":
             options["debug"] = True
         elif o == "-S":
@@ -87,6 +198,31 @@ def parse_args(outstream, input):
                 options["rom_size"] = ROMSIZE(int(a))
             except ValueError as err:
                 usage(outstream, err)
+        elif o == "-T":
+            try:
+                options["ready_deadline"] = float(a)
+            except ValueError as err:
+                usage(outstream, err)
+        elif o == "-A":
+            try:
+                options["ack_deadline"] = float(a)
+            except ValueError as err:
+                usage(outstream, err)
+        elif o == "-R":
+            try:
+                options["retries"] = int(a)
+            except ValueError as err:
+                usage(outstream, err)
+        elif o == "-B":
+            try:
+                options["baudrate"] = a if a == "auto" else int(a)
+            except ValueError as err:
+                usage(outstream, err)
+        elif o == "-P":
+            try:
+                options["window"] = int(a)
+            except ValueError as err:
+                usage(outstream, err)
 
     if options["verify_rom"] and options["dump_rom"]:
         usage(outstream, "Can't verify AND dump to file...choose one or other.")
@@ -94,44 +230,191 @@ def parse_args(outstream, input):
         usage(outstream, "Must provide ROM file to verify against.")
     if options["dump_rom"] and not options["rom_file"]:
         usage(outstream, "Must provide ROM file name to dump to.")
+    if len(options["ports"]) > 1:
+        if options["dump_rom"] or options["version"]:
+            usage(outstream, "Can't dump or print version from more than one port.")
+        if options["reading"] and not options["verify_rom"]:
+            usage(outstream, "Gang mode needs -w or -v.")
+        if options["verify_report"]:
+            usage(outstream, "Can't write a verify report in gang mode.")
+        if options["record"] or options["replay"]:
+            usage(outstream, "Can't record or replay in gang mode.")
+    if options["daemon"] and (options["socket"] or len(options["ports"]) > 1):
+        usage(outstream, "A daemon owns a single port and can't send jobs to another daemon.")
+    if options["trust_cache"] and not options["chip_id"]:
+        usage(outstream, "--trust-cache needs a --chip-id to know which EEPROM it is.")
+    if options["skip_blank"] and options["reading"]:
+        usage(outstream, "--skip-blank only applies when writing with -w.")
     if ((options["end"] - options["start"]) > options["rom_size"] * 1024):
         usage(outstream, "Address range is bigger than EEPROM size.")
+    if options["ranges"]:
+        if options["start"] or options["end"]:
+            usage(outstream, "Can't mix -s/-e with --range or --range-file.")
+        try:
+            options["ranges"] = merge_ranges(options["ranges"], RECORD_SIZE, options["rom_size"] * 1024)
+        except ValueError as err:
+            usage(outstream, err)
     if options["version"]:
         options["reading"] = True
         options["start"] = -1
         options["end"] = -1
+        options["ranges"] = []
         return options
     
     return options
 
-def main(outstream, args):
-    WAIT_FOR_ARDUINO_IN_SECS = 1 # Minimum of 1 sec required
-    options = parse_args(outstream, args[1:])
+def open_programmer(port, options, print_stream):
+    stats = Stats() if options["stats"] else None
+    eeprom = open_eeprom(port, options, print_stream, stats)
+    return configure_programmer(eeprom, options, print_stream, stats)
 
-    eeprom = EEPROM(options["rom_size"] * 1024)
-    if options["debug"]:
-        print("DEBUG MODE", outstream)
-        options["TTY"] = FakeSerial(options["TTY"])
-        
-    try:
-        eeprom.open_port(options["TTY"])
-        sleep(WAIT_FOR_ARDUINO_IN_SECS)
-    except EEPROMException:
-        print("No serial device attached.", file=outstream)
-        exit(-2)
-    
-    programmer = Programmer(eeprom, outstream)
+def open_eeprom(port, options, print_stream, stats=None):
+    wrap_port = None
+    if options["record"]:
+        wrap_port = lambda serial_port: RecordingPort(serial_port, options["record"], options.get("record_meta"))
+    # The emulator is ready straight away, unless it has to answer a baud rate probe
+    skip_wait = options["debug"] and options["baudrate"] != "auto"
+    session = Session(port, options["rom_size"] * 1024, options["baudrate"], options["window"], options["retries"],
+                      None if skip_wait else options["ready_deadline"], options["binary"], wrap_port, stats,
+                      options["ack_deadline"])
+    eeprom = session.open().eeprom
+    if options["baudrate"] == "auto" and not options["debug"]:
+        print("Serial link running at {} baud.".format(eeprom.baudrate), file=print_stream)
+    if session.negotiated:
+        print("Using {} protocol.".format(session.negotiated.name), file=print_stream)
+    if stats:
+        instrument(eeprom, stats)
+    return eeprom
+
+def configure_programmer(eeprom, options, print_stream, stats=None):
+    programmer = Programmer(eeprom, print_stream)
     programmer.set_start(options["start"])
     programmer.set_end(options["end"])
+    if options["ranges"]:
+        programmer.set_ranges(options["ranges"])
     programmer.set_verify(options["verify_rom"])
     programmer.set_debug(options["debug"])
+    programmer.set_hexdump(options["hexdump"])
+    programmer.set_diff_write(options["diff_write"])
+    programmer.set_crc_verify(options["crc_verify"])
+    programmer.set_blank_check(options["blank_check"])
+    programmer.set_skip_blank(options["skip_blank"])
+    if options["chip_id"]:
+        version = eeprom.firmware_version or eeprom.version().strip()
+        shadow = ShadowCache(options["cache_dir"]).load(port_name(eeprom.port), version, options["chip_id"], eeprom.rom_size)
+        programmer.set_shadow(shadow, options["trust_cache"])
+    programmer.set_verify_report(options["verify_report"])
+    programmer.set_resume(options["resume"])
+    programmer.set_stats(stats, options["stats"] == "json")
+    return programmer
 
+def load_files(programmer, options):
     if (not options["reading"]) or options["verify_rom"]:
         programmer.set_input_rom(options["rom_file"])
     elif options["dump_rom"]:
         programmer.set_dump_file(options["rom_file"])
 
-    if options["reading"]:
-        programmer.read_eeprom()
+def run(programmer, options):
+    try:
+        if options["reading"]:
+            programmer.read_eeprom()
+        else:
+            programmer.write_eeprom()
+    except (EEPROMException, SystemExit, KeyboardInterrupt):
+        programmer.save_shadow(failed=True)
+        raise
+    programmer.save_shadow()
+    if programmer.non_blank is not None and options["reading"]:
+        exit(-5)
+
+def gang(outstream, options):
+    rom_file = options["rom_file"]
+    # Parse the file once; every device gets the same image
+    segments = None
+    if image_format(rom_file):
+        try:
+            segments = load_segments(rom_file)
+        except ImageFormatError as err:
+            print("Can't load {}: {}".format(rom_file, err), file=outstream)
+            exit(-1)
     else:
-        programmer.write_eeprom()
\ No newline at end of file
+        rom_size, rom = read_rom_from_file(rom_file)
+
+    def setup(port, log):
+        if options["debug"]:
+            port = FakeSerial(port, rom_size=options["rom_size"] * 1024)
+        programmer = open_programmer(port, options, log)
+        if segments is not None:
+            programmer.set_segments(rom_file, segments)
+        else:
+            programmer.set_rom_image(rom_file, rom_size, rom)
+        # One journal per programmer so --resume picks up each device separately
+        device = os.path.basename(str(port_name(port)))
+        programmer.set_journal_file("{}.{}.journal".format(rom_file, device))
+        return programmer
+
+    print("Gang programming {} devices.".format(len(options["ports"])), file=outstream)
+    results = gang_program(options["ports"], setup, lambda programmer: run(programmer, options))
+    print_report(results, outstream)
+    if not all(result.passed for result in results):
+        exit(-3)
+
+def daemon_job(eeprom):
+    def execute(args, cwd, outstream):
+        # Paths in the job are relative to the client, not to the daemon
+        options = parse_args(outstream, args, cwd)
+        eeprom.set_window(options["window"])
+        eeprom.set_retry_policy(options["retries"])
+        eeprom.set_ack_deadline(options["ack_deadline"])
+        # The daemon's EEPROM outlives the job, so it isn't instrumented per job
+        programmer = configure_programmer(eeprom, options, outstream)
+        load_files(programmer, options)
+        run(programmer, options)
+    return execute
+
+def main(outstream, args):
+    options = parse_args(outstream, args[1:])
+    if options["socket"]:
+        exit(submit(options["socket"], client_args(args[1:]), outstream))
+    if len(options["ports"]) > 1:
+        return gang(outstream, options)
+
+    if options["debug"]:
+        print("DEBUG MODE", outstream)
+    if options["replay"]:
+        options["TTY"] = ReplaySerial(options["replay"], options["replay_speed"])
+    elif options["debug"]:
+        options["TTY"] = FakeSerial(options["TTY"], rom_size=options["rom_size"] * 1024)
+    if options["record"]:
+        # Enough to run the same session again against the transcript
+        options["record_meta"] = {"args": without_option([str(arg) for arg in args[1:]], "--record"), "cwd": os.getcwd(),
+                                  "baudrate": options["baudrate"]}
+
+    try:
+        if options["daemon"]:
+            eeprom = open_eeprom(options["TTY"], options, outstream)
+        else:
+            programmer = open_programmer(options["TTY"], options, outstream)
+    except (EEPROMTimeout, EEPROMUnsupported) as err:
+        print(err, file=outstream)
+        exit(-2)
+    except EEPROMException:
+        print("No serial device attached.", file=outstream)
+        exit(-2)
+
+    if options["daemon"]:
+        try:
+            return serve(options["daemon"], daemon_job(eeprom), outstream)
+        except DaemonRunning as err:
+            print(err, file=outstream)
+            eeprom.close()
+            exit(-2)
+
+    load_files(programmer, options)
+    try:
+        run(programmer, options)
+    except EEPROMException as err:
+        print(err, file=outstream)
+        programmer.programmer.close()
+        exit(-4)
+    programmer.programmer.close()
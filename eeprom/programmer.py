@@ -1,8 +1,21 @@
 from serial import Serial
+from itertools import islice
+import mmap
+from zlib import crc32
 from time import sleep
 import sys
-import struct
-from .writer import EEPROM, data_field, address_field
+from .writer import EEPROM, EEPROMException, data_field, address_field
+from .verify import diff_ranges, join_ranges, summarise, write_report
+from .stats import phase
+from .journal import Journal
+from .hexfile import ImageFormatError, image_format, load_segments
+from .hexdump import hexdump_lines
+
+SPOT_CHECK_RECORDS = 4
+DUMP_BUFFER_SIZE = 64 * 1024
+PRINT_BATCH_LINES = 256
+READ_CHUNK_BYTES = 4096
+BLANK = 0xff
 
 class Programmer():
     def __init__(self, eeprom_programmer, print_stream):
@@ -17,6 +30,25 @@ class Programmer():
         self.programmer = eeprom_programmer
         self.RECSIZE = 16
         self.debug = False
+        self.diff_write = False
+        self.report_file = None
+        self.differences = []
+        self.stats = None
+        self.stats_json = False
+        self.resume = False
+        self.journal_file = None
+        self.present = None
+        self.ranges = None
+        self.hexdump = False
+        self.crc_verify = False
+        self.blank_check = False
+        self.skip_blank = False
+        self.non_blank = None
+        self.blank_skipped = 0
+        self.unchanged_skipped = 0
+        self.shadow = None
+        self.trust_cache = False
+        self.written = set()
     
     def set_start(self, start):
         self.start = start
@@ -24,15 +56,121 @@ class Programmer():
     def set_end(self, end):
         self.end = end
     
+    def set_ranges(self, ranges):
+        self.ranges = ranges
+        self.start = ranges[0][0]
+        self.end = ranges[-1][1]
+    
+    def address_ranges(self):
+        return self.ranges or [(self.start, self.end)]
+    
     def set_verify(self, verify):
         self.verify_rom = verify
     
+    def set_hexdump(self, hexdump):
+        self.hexdump = hexdump
+    
     def set_debug(self, debug):
         self.debug = debug
     
+    def set_crc_verify(self, crc_verify):
+        self.crc_verify = crc_verify
+    
+    def set_blank_check(self, blank_check):
+        self.blank_check = blank_check
+    
+    def set_skip_blank(self, skip_blank):
+        self.skip_blank = skip_blank
+    
+    def set_shadow(self, shadow, trust=False):
+        self.shadow = shadow
+        self.trust_cache = trust
+    
+    def save_shadow(self, failed=False):
+        if self.shadow:
+            if failed:
+                # Can't tell what state the device was left in
+                self.shadow.invalidate()
+            self.shadow.save()
+    
+    def cached(self, start, end):
+        # Records written in this run only have the image in the shadow, not
+        # what the device took, so they're always read back.
+        if any(address in self.written for address in range(start, end, self.RECSIZE)):
+            return False
+        return self.trust_cache and self.shadow is not None and self.shadow.known(start, end)
+    
+    def read_chunk(self, start, end):
+        end = start + len(range(start, end, self.RECSIZE)) * self.RECSIZE
+        if self.cached(start, end):
+            return self.shadow.read(start, end)
+        data = self.programmer.read_range(start, end)
+        if self.shadow:
+            self.shadow.store(start, data)
+        return data
+    
+    def iter_records(self, start, end):
+        rounded = start + len(range(start, end, self.RECSIZE)) * self.RECSIZE
+        if self.cached(start, rounded):
+            yield from split_records(start, self.shadow.read(start, rounded), self.RECSIZE)
+            return
+        for address, record in self.programmer.iter_range(start, end):
+            if self.shadow:
+                self.shadow.store(address, record)
+            yield address, record
+    
+    def set_diff_write(self, diff_write):
+        self.diff_write = diff_write
+    
+    def set_verify_report(self, filename):
+        self.report_file = filename
+    
+    def set_resume(self, resume):
+        self.resume = resume
+    
+    def set_journal_file(self, filename):
+        self.journal_file = filename
+    
+    def set_stats(self, stats, as_json=False):
+        self.stats = stats
+        self.stats_json = as_json
+    
+    def report_stats(self):
+        if self.stats:
+            self.stats.report(self.programmer, self.stats_json, self.print_stream)
+    
     def set_input_rom(self, filename):
+        if image_format(filename):
+            try:
+                with phase(self.stats, "file_io"):
+                    segments = load_segments(filename)
+            except ImageFormatError as err:
+                print("Can't load {}: {}".format(filename, err), file=self.print_stream)
+                exit(-1)
+            return self.set_segments(filename, segments)
+        with phase(self.stats, "file_io"):
+            rom_size, rom = read_rom_from_file(filename)
+        self.set_rom_image(filename, rom_size, rom)
+    
+    def set_segments(self, filename, segments):
         self.file_name = filename
-        rom_size, self.rom_src = read_rom_from_file(filename, self.RECSIZE)
+        print("ROM file holds {} bytes in {} segments.".format(sum(len(data) for address, data in segments), len(segments)), file=self.print_stream)
+        if not self.end and segments:
+            self.end = max(address + len(data) for address, data in segments)
+        image = bytearray(b'\xff' * max(0, self.end - self.start))
+        self.present = set()
+        for address, data in segments:
+            first = max(address, self.start)
+            last = min(address + len(data), self.end)
+            if first >= last:
+                continue
+            image[first - self.start:last - self.start] = data[first - address:last - address]
+            self.present.update(range((first - self.start) // self.RECSIZE, (last - 1 - self.start) // self.RECSIZE + 1))
+        self.rom_src = memoryview(image)
+    
+    def set_rom_image(self, filename, rom_size, rom):
+        self.file_name = filename
+        self.rom_src = rom
         print("ROM file is {} bytes long.".format(rom_size), file=self.print_stream)
         if rom_size < (self.end - self.start):
             print("The ROM file is smaller than the specified address range.", file=self.print_stream)
@@ -42,52 +180,199 @@ class Programmer():
         self.dump_rom = True
         self.file_name = filename
         print("Writing contents to ", filename, file=self.print_stream)
-        self.output_stream = open(filename, 'wb')
-    
-    def format_record(self, input, record, formatter):
-        output = str(input) + ":"
-        for i in range(self.RECSIZE):
-            output += (" %02x" % formatter(record, i)).upper()
-        return output
-    
-    def check_diff(self, address, eprom_record):
-        output = ""
-        actual = self.format_record(address, eprom_record, rom_byte)
-        file_index = int((address - self.start) / self.RECSIZE)
-        file_record = self.format_record(address, self.rom_src[file_index], file_byte)
-        if actual != file_record:
-            output = "DIFF:\n"
-            output += "\tROM :" + actual + "\n"
-            output += "\tFILE:" + file_record + "\n"
-        return output
+        self.output_stream = open(filename, 'wb', buffering=DUMP_BUFFER_SIZE)
+    
+    def print_lines(self, lines):
+        lines = iter(lines)
+        batch = list(islice(lines, PRINT_BATCH_LINES))
+        while batch:
+            print("\n".join(batch), file=self.print_stream)
+            batch = list(islice(lines, PRINT_BATCH_LINES))
+    
+    def rom_record(self, address):
+        offset = address - self.start
+        return self.rom_src[offset:offset + self.RECSIZE]
+    
+    def record_addresses(self, first=0):
+        return (address for start, end in self.address_ranges()
+                for address in range(max(start, first), end, self.RECSIZE))
+    
+    def record_count(self, first=0):
+        return sum(len(range(max(start, first), end, self.RECSIZE)) for start, end in self.address_ranges())
+    
+    def read_blocks(self, first=0):
+        # A chunk at a time, so verifying a big part doesn't hold all of it
+        for start, end in self.address_ranges():
+            for chunk in range(max(start, first), end, READ_CHUNK_BYTES):
+                yield chunk, self.read_chunk(chunk, min(chunk + READ_CHUNK_BYTES, end))
+    
+    def expected_block(self, address, data):
+        offset = address - self.start
+        if self.present is None:
+            return pad_record(self.rom_src[offset:offset + len(data)], len(data))
+        # Sparse images only vouch for the records they cover
+        expected = bytearray(data)
+        for index in range(offset // self.RECSIZE, (offset + len(data) - 1) // self.RECSIZE + 1):
+            if index in self.present:
+                position = index * self.RECSIZE
+                expected[position - offset:position - offset + self.RECSIZE] = pad_record(self.rom_src[position:position + self.RECSIZE], self.RECSIZE)
+        return expected[:len(data)]
+    
+    def verify(self, blocks):
+        ranges = []
+        bytes_compared = 0
+        for address, data in blocks:
+            ranges.extend(diff_ranges(address, data, self.expected_block(address, data)))
+            bytes_compared += len(data)
+        return self.report_differences(join_ranges(ranges), bytes_compared)
+    
+    def checked_spans(self):
+        # Whole records, and for sparse images only the runs of records the image covers
+        for start, end in self.address_ranges():
+            end = start + len(range(start, end, self.RECSIZE)) * self.RECSIZE
+            if self.present is None:
+                yield start, end
+                continue
+            run = None
+            for address in range(start, end, self.RECSIZE):
+                if (address - self.start) // self.RECSIZE in self.present:
+                    if run is None:
+                        run = address
+                elif run is not None:
+                    yield run, address
+                    run = None
+            if run is not None:
+                yield run, end
+    
+    def crc_mismatches(self, start, end):
+        offset = start - self.start
+        expected = pad_record(self.rom_src[offset:offset + end - start], end - start)
+        if self.programmer.range_crc(start, end) == crc32(expected):
+            return []
+        records = len(range(start, end, self.RECSIZE))
+        if records == 1:
+            return diff_ranges(start, self.programmer.read_range(start, end)[:end - start], expected)
+        middle = start + records // 2 * self.RECSIZE
+        return self.crc_mismatches(start, middle) + self.crc_mismatches(middle, end)
+    
+    def verify_device(self):
+        if not (self.crc_verify and self.programmer.supports("+CRC")):
+            return self.verify(self.read_blocks())
+        spans = list(self.checked_spans())
+        ranges = []
+        for start, end in spans:
+            ranges.extend(self.crc_mismatches(start, end))
+        return self.report_differences(join_ranges(ranges), sum(end - start for start, end in spans))
+    
+    def report_differences(self, ranges, bytes_compared):
+        self.differences = ranges
+        print(summarise(ranges, bytes_compared), file=self.print_stream)
+        if self.report_file:
+            write_report(self.report_file, self.start, ranges, bytes_compared, self.end)
+        return ranges
+    
+    def changed_records(self, first, records):
+        # All the reading has to be done before the writes start, but only
+        # the addresses that differ are kept.
+        changed = set(address for start, data in self.read_blocks(first)
+                      for address, current in split_records(start, data, self.RECSIZE)
+                      if current != pad_record(self.rom_record(address), self.RECSIZE))
+        return self.skip_unchanged_records(changed, records)
+    
+    def skip_unchanged_records(self, changed, records):
+        for address, data in records:
+            if address in changed:
+                yield address, data
+            else:
+                self.unchanged_skipped += 1
+    
+    def resume_point(self, journal):
+        confirmed = journal.resume_point()
+        if confirmed is None:
+            print("No matching write journal, writing from the start.", file=self.print_stream)
+            return self.start
+        holding = [start for start, end in self.address_ranges() if start < confirmed <= end]
+        if not holding:
+            print("Write journal has nothing confirmed, writing from the start.", file=self.print_stream)
+            return self.start
+        # Only look back within the range holding the last confirmed record
+        range_start = holding[0]
+        check_from = max(range_start, confirmed - SPOT_CHECK_RECORDS * self.RECSIZE)
+        readback = self.programmer.read_range(check_from, confirmed)
+        expected = pad_record(self.rom_src[check_from - self.start:confirmed - self.start], len(readback))
+        if readback != expected:
+            print("Spot check of the last records written failed, writing from the start.", file=self.print_stream)
+            return self.start
+        print("Resuming from address {}.".format(confirmed), file=self.print_stream)
+        journal.confirm(confirmed)
+        return confirmed
+    
+    def first_non_blank(self):
+        for start, end in self.address_ranges():
+            if self.crc_verify and self.programmer.supports("+CRC"):
+                if self.programmer.range_crc(start, end) == crc32(bytes([BLANK]) * (end - start)):
+                    continue
+            records = self.programmer.iter_range(start, end)
+            for address, record in records:
+                record = bytes(record[:end - address])
+                offset = len(record) - len(record.lstrip(bytes([BLANK])))
+                if offset < len(record):
+                    # Stop reading, and clear out anything still pipelined
+                    records.close()
+                    self.programmer.drain()
+                    return address + offset, record[offset]
+        return None
+    
+    def check_blank(self):
+        self.non_blank = self.first_non_blank()
+        if self.non_blank is None:
+            print("Blank check OK: {} bytes are FF.".format(sum(end - start for start, end in self.address_ranges())), file=self.print_stream)
+        else:
+            print("Blank check FAILED: {} holds {:02X}.".format(address_field(self.non_blank[0]), self.non_blank[1]), file=self.print_stream)
+        return self.non_blank is None
+    
+    def skip_blank_records(self, records):
+        for address, data in records:
+            if pad_record(data, self.RECSIZE) == bytes([BLANK]) * self.RECSIZE:
+                self.blank_skipped += 1
+            else:
+                yield address, data
     
     def read_eeprom(self):
         if self.start < 0:
             print(self.programmer.version(), file=self.print_stream)
             return 
 
-        print("Reading EEPROM from {} to {}".format(self.start, self.end), file=self.print_stream)
+        for start, end in self.address_ranges():
+            print("Reading EEPROM from {} to {}".format(start, end), file=self.print_stream)
+        if self.blank_check:
+            self.check_blank()
+            self.report_stats()
+            return
         if self.verify_rom:
             print("Verifying...", file=self.print_stream)
         if self.dump_rom:
             print( "Dumping to file.", file=self.print_stream)
         bytes_written = 0
-        address = self.start
-        while (address < self.end):
-            record = self.programmer.read(address)
-            if self.verify_rom:
-                diff = self.check_diff(address, record)
-                if diff:
-                    print(diff, file=self.print_stream)
-            elif self.dump_rom:
-                bytes_written += write_record_to_file(record, self.output_stream)
+        for start, end in ([] if self.verify_rom else self.address_ranges()):
+            records = self.iter_records(start, end)
+            if self.dump_rom:
+                # Gaps between ranges are dumped as FF so file offsets still match addresses
+                bytes_written += self.output_stream.write(b'\xff' * (start - self.start - bytes_written))
+                for address, record in records:
+                    with phase(self.stats, "file_io"):
+                        bytes_written += self.output_stream.write(record)
+            elif self.hexdump:
+                self.print_lines(hexdump_lines(records))
             else:
-                print(record, file=self.print_stream)
-            address += self.RECSIZE
+                self.print_lines(address_field(address) + ":" + data_field(record) for address, record in records)
+        if self.verify_rom:
+            self.verify_device()
         
         if self.dump_rom:
             print("bytes written:" + str(bytes_written), file=self.print_stream)
             self.output_stream.close()
+        self.report_stats()
         return
     
     def write_eeprom(self):
@@ -95,41 +380,64 @@ class Programmer():
             print("EEPROM size is {} but you are trying to write to write {} bytes\n".format(self.programmer.rom_size, (self.end - self.start)), file=self.print_stream)
             exit(-1)
         print("Writing ROM {} to EEPROM.".format(self.file_name), file=self.print_stream)
-        address = self.start
-        while address < self.end:
-            record = self.rom_src[int(address / self.RECSIZE)]
-            cmd_sent = self.programmer.write(address, record)
-            if self.verify_rom:
-                readback = self.programmer.read(address)
-                diff = self.check_diff(address, readback)
-                if diff:
-                    print(diff, file=self.print_stream)
-            address += self.RECSIZE
+        self.written = set()
+        blank = None
+        if self.blank_check or self.skip_blank:
+            blank = self.check_blank()
+            if self.blank_check and not blank:
+                print("Not writing to an EEPROM that isn't blank.", file=self.print_stream)
+                exit(-5)
+            if self.skip_blank and not blank:
+                print("Writing blank records too.", file=self.print_stream)
+        journal = Journal(self.journal_file or self.file_name + ".journal", self.rom_src[:self.end - self.start],
+                          self.programmer.firmware_version, self.start, self.end, self.ranges)
+        first = self.resume_point(journal) if self.resume else self.start
+        addresses = self.record_addresses(first)
+        records = ((address, self.rom_record(address)) for address in addresses)
+        if self.present is not None:
+            in_image = sum(1 for address in self.record_addresses() if (address - self.start) // self.RECSIZE in self.present)
+            print("Image has data in {} of {} records.".format(in_image, self.record_count()), file=self.print_stream)
+            records = ((address, data) for address, data in records
+                       if (address - self.start) // self.RECSIZE in self.present)
+        if self.diff_write:
+            records = self.changed_records(first, records)
+        if self.skip_blank and blank:
+            # The part is already all FF, so blank records need no write
+            records = self.skip_blank_records(records)
+        records_written = 0
+        try:
+            for address, cmd_sent in self.programmer.write_records(records):
+                records_written += 1
+                self.written.add(address)
+                journal.confirm(address + self.RECSIZE)
+                if self.shadow:
+                    self.shadow.store(address, pad_record(self.rom_record(address), self.RECSIZE))
+        except (EEPROMException, SystemExit, KeyboardInterrupt):
+            journal.save()
+            raise
+        journal.remove()
+        if self.diff_write:
+            print("Skipped {} unchanged records, wrote {}.".format(self.unchanged_skipped, records_written), file=self.print_stream)
+        if self.skip_blank and blank:
+            print("Skipped {} blank records.".format(self.blank_skipped), file=self.print_stream)
+        if self.verify_rom:
+            self.verify_device()
+        self.report_stats()
         return
 
-def read_rom_from_file(rom_file, recsize):
-    rom = []
-    num_bytes = 0
+def read_rom_from_file(rom_file):
     with open(rom_file, 'rb') as rom_src:
-        for record in iter(lambda: rom_src.read(recsize), b''):
-            rom.append(record)
-            num_bytes += len(record)
-    return num_bytes, rom
-
-def write_record_to_file(record, output):
-    data = record[5:-5]
-    bytes_written = 0
-    for i in range(0, 64, 2):
-        byte_string = data[i:i+2]
-        if byte_string:
-            byte = struct.pack("B", int(byte_string, 16))
-            bytes_written += output.write(byte)
-    return bytes_written
+        try:
+            rom = mmap.mmap(rom_src.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            rom = b''
+    return len(rom), memoryview(rom)
 
-def rom_byte(record, index):
-    i = 5 + (index*2)
-    byte = int(record[i:i+2], 16)
-    return byte
+def split_records(start, data, recsize):
+    data = memoryview(data)
+    for offset in range(0, len(data), recsize):
+        yield start + offset, data[offset:offset + recsize]
 
-def file_byte(record, index):
-    return record[index]
\ No newline at end of file
+def pad_record(data, recsize):
+    return bytes(data) + b'\xff' * (recsize - len(data))
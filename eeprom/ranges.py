@@ -0,0 +1,36 @@
+def parse_range(text):
+    try:
+        start, end = text.split("-")
+        start, end = int(start, 0), int(end, 0)
+    except ValueError:
+        raise ValueError("Bad address range '{}', expected start-end.".format(text))
+    if start < 0 or end <= start:
+        raise ValueError("Address range '{}' is empty.".format(text))
+    return start, end
+
+def parse_ranges(text):
+    return [parse_range(item.strip()) for item in text.split(",") if item.strip()]
+
+def read_range_file(filename):
+    ranges = []
+    try:
+        with open(filename) as range_file:
+            for line in range_file:
+                line = line.split("#")[0]
+                ranges.extend(parse_range(item) for item in line.replace(",", " ").split())
+    except OSError as err:
+        raise ValueError("Can't read range file {}: {}".format(filename, err.strerror))
+    return ranges
+
+def merge_ranges(ranges, recsize, limit):
+    # Whole records only, so adjacent ranges sharing a record collapse too
+    aligned = sorted((start - start % recsize, -(-end // recsize) * recsize) for start, end in ranges)
+    merged = []
+    for start, end in aligned:
+        if end > limit:
+            raise ValueError("Address range {}-{} is outside the {} byte EEPROM.".format(start, end, limit))
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
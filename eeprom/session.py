@@ -0,0 +1,99 @@
+from collections import namedtuple
+from .writer import EEPROM, DEFAULT_BAUDRATE, DEFAULT_RETRIES, ACK_DEADLINE_IN_SECS, READY_DEADLINE_IN_SECS, BAUDRATES, SHORT_ADDRESS_LIMIT
+from .verify import diff_ranges
+from .stats import phase
+
+WriteResult = namedtuple("WriteResult", ["records_written", "differences"])
+
+class Session():
+    # Library entry point: results come back as values and failures as
+    # exceptions, nothing is printed and nothing calls exit().
+    def __init__(self, port, rom_size=8192, baudrate=DEFAULT_BAUDRATE, window=1, retries=DEFAULT_RETRIES,
+                 ready_deadline=READY_DEADLINE_IN_SECS, binary=False, wrap_port=None, stats=None,
+                 ack_deadline=ACK_DEADLINE_IN_SECS):
+        # ready_deadline=None skips waiting for the programmer, for ports
+        # that are known to be ready already
+        if baudrate == "auto" and ready_deadline is None:
+            raise ValueError("Probing for the baud rate needs a ready deadline.")
+        self.port = port
+        self.baudrate = baudrate
+        self.ready_deadline = ready_deadline
+        self.binary = binary
+        self.wrap_port = wrap_port
+        self.stats = stats
+        self.negotiated = None
+        self.eeprom = EEPROM(rom_size)
+        self.eeprom.set_window(window)
+        self.eeprom.set_retry_policy(retries)
+        self.eeprom.set_ack_deadline(ack_deadline)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        with phase(self.stats, "open_port"):
+            self.connect()
+        if self.wrap_port:
+            self.eeprom.port = self.wrap_port(self.eeprom.port)
+        with phase(self.stats, "wait_ready"):
+            self.wait_ready()
+        if self.extended():
+            # The binary frames only carry 16-bit addresses
+            self.negotiated = self.eeprom.negotiate_extended()
+        elif self.binary:
+            self.negotiated = self.eeprom.negotiate_binary()
+        return self
+
+    def extended(self):
+        return self.eeprom.rom_size > SHORT_ADDRESS_LIMIT
+
+    def connect(self):
+        self.eeprom.open_port(self.port, BAUDRATES[0] if self.baudrate == "auto" else self.baudrate)
+
+    def wait_ready(self):
+        if self.ready_deadline is None:
+            return
+        if self.baudrate == "auto":
+            self.eeprom.probe_baudrate(BAUDRATES, self.ready_deadline)
+        else:
+            self.eeprom.wait_until_ready(self.ready_deadline)
+
+    def close(self):
+        self.eeprom.close()
+
+    def check_range(self, start, end):
+        if start < 0 or end < start or end > self.eeprom.rom_size:
+            raise ValueError("Address range {}-{} is outside the {} byte EEPROM.".format(start, end, self.eeprom.rom_size))
+
+    def version(self):
+        return self.eeprom.version().strip()
+
+    def read_image(self, start, end):
+        self.check_range(start, end)
+        return bytes(self.eeprom.read_range(start, end)[:end - start])
+
+    def write_image(self, start, data, verify=False):
+        end = start + len(data)
+        self.check_range(start, end)
+        recsize = self.eeprom.RECSIZE
+        first = start - start % recsize
+        last = -(-end // recsize) * recsize
+        # Records are written whole, so keep what the device already holds
+        # either side of the data in the first and last record.
+        image = bytearray(b'\xff' * (last - first))
+        if first < start:
+            image[:recsize] = self.eeprom.read_range(first, first + recsize)
+        if last > end and not (first < start and last - recsize == first):
+            image[-recsize:] = self.eeprom.read_range(last - recsize, last)
+        image[start - first:end - first] = data
+        image = memoryview(image)
+        records = ((first + offset, image[offset:offset + recsize])
+                   for offset in range(0, len(image), recsize))
+        records_written = sum(1 for record in self.eeprom.write_records(records))
+        return WriteResult(records_written, self.verify(start, data) if verify else None)
+
+    def verify(self, start, data):
+        return diff_ranges(start, self.read_image(start, start + len(data)), data)
@@ -0,0 +1,86 @@
+from hashlib import sha256
+import json
+import os
+from .ranges import merge_ranges
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "eepromer")
+DEFAULT_CACHE_BYTES = 16 * 1024 * 1024
+
+class Shadow():
+    # Last known contents of one device, and which parts of it are known
+    def __init__(self, cache, key, size, image=None, valid=()):
+        self.cache = cache
+        self.key = key
+        self.image = image if image is not None else bytearray(b'\xff' * size)
+        self.valid = [tuple(address_range) for address_range in valid]
+
+    def known(self, start, end):
+        return any(first <= start and end <= last for first, last in self.valid)
+
+    def read(self, start, end):
+        return self.image[start:end]
+
+    def store(self, start, data):
+        data = data[:len(self.image) - start]
+        if data:
+            self.image[start:start + len(data)] = data
+            self.valid = merge_ranges(self.valid + [(start, start + len(data))], 1, len(self.image))
+
+    def invalidate(self):
+        self.valid = []
+
+    def save(self):
+        self.cache.save(self)
+
+class ShadowCache():
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, port, version, chip_id):
+        return sha256("{}\n{}\n{}".format(port, version, chip_id).encode()).hexdigest()[:32]
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def load(self, port, version, chip_id, size):
+        key = self.key(port, version, chip_id)
+        try:
+            with open(self.path(key, ".json")) as entry_file:
+                entry = json.load(entry_file)
+            with open(self.path(key, ".img"), 'rb') as image_file:
+                image = bytearray(image_file.read())
+        except (OSError, ValueError):
+            return Shadow(self, key, size)
+        if entry.get("size") != size or len(image) != size:
+            return Shadow(self, key, size)
+        os.utime(self.path(key, ".img"))
+        return Shadow(self, key, size, image, entry.get("valid", ()))
+
+    def save(self, shadow):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path(shadow.key, ".img"), 'wb') as image_file:
+                image_file.write(shadow.image)
+            with open(self.path(shadow.key, ".json"), 'w') as entry_file:
+                json.dump({"size": len(shadow.image), "valid": shadow.valid}, entry_file)
+        except OSError:
+            # A cache that can't be written is just a cache miss next time
+            return
+        self.evict()
+
+    def evict(self):
+        # Least recently saved devices go first once the cache is over size
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".img"):
+                path = os.path.join(self.directory, name)
+                entries.append((os.path.getmtime(path), os.path.getsize(path), name[:-4]))
+        total = sum(size for mtime, size, key in entries)
+        for mtime, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for extension in (".img", ".json"):
+                if os.path.exists(self.path(key, extension)):
+                    os.remove(self.path(key, extension))
+            total -= size
@@ -0,0 +1,138 @@
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+import json
+
+class Histogram():
+    # Latencies land in power-of-two microsecond buckets: bucket n holds
+    # everything below 2**n us.
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total_secs": self.total,
+            "mean_us": self.mean() * 1e6,
+            "max_us": self.max * 1e6,
+            "buckets_us": {str(2 ** bucket): count for bucket, count in sorted(self.buckets.items())}
+        }
+
+class Stats():
+    def __init__(self):
+        self.started = perf_counter()
+        self.latency = {}
+        self.phases = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def record(self, name, seconds):
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = Histogram()
+        histogram.add(seconds)
+
+    @contextmanager
+    def phase(self, name):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + perf_counter() - started
+
+    def as_dict(self, eeprom):
+        elapsed = perf_counter() - self.started
+        return {
+            "elapsed_secs": elapsed,
+            "baudrate": eeprom.baudrate,
+            "protocol": eeprom.protocol.name,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "bytes_per_sec": (self.bytes_sent + self.bytes_received) / elapsed if elapsed else 0.0,
+            "retries": eeprom.retries,
+            "phases_secs": dict(self.phases),
+            "latency": {name: histogram.as_dict() for name, histogram in sorted(self.latency.items())}
+        }
+
+    def summary(self, eeprom):
+        stats = self.as_dict(eeprom)
+        lines = [
+            "Stats: {:.3f}s at {} baud using the {} protocol".format(stats["elapsed_secs"], stats["baudrate"], stats["protocol"]),
+            "\tsent {} bytes, received {} bytes, {:.0f} bytes/s".format(stats["bytes_sent"], stats["bytes_received"], stats["bytes_per_sec"]),
+            "\tretries: {}".format(stats["retries"])
+        ]
+        for name, seconds in sorted(stats["phases_secs"].items()):
+            lines.append("\t{}: {:.3f}s".format(name, seconds))
+        for name, histogram in sorted(self.latency.items()):
+            lines.append("\t{}: {} calls, {:.3f}s total, mean {:.1f}us, max {:.1f}us".format(
+                name, histogram.count, histogram.total, histogram.mean() * 1e6, histogram.max * 1e6))
+            lines.append("\t\t" + " ".join("<{}us:{}".format(2 ** bucket, count) for bucket, count in sorted(histogram.buckets.items())))
+        return "\n".join(lines)
+
+    def report(self, eeprom, as_json, print_stream):
+        if as_json:
+            print(json.dumps(self.as_dict(eeprom), indent=2), file=print_stream)
+        else:
+            print(self.summary(eeprom), file=print_stream)
+
+class CountingPort():
+    def __init__(self, port, stats):
+        self.port = port
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def write(self, data):
+        self.stats.bytes_sent += len(data)
+        return self.port.write(data)
+
+    def readline(self):
+        line = self.port.readline()
+        self.stats.bytes_received += len(line)
+        return line
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        self.stats.bytes_received += len(data)
+        return data
+
+def timed(stats, name, method):
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stats.record(name, perf_counter() - started)
+    return wrapper
+
+def instrument(eeprom, stats):
+    # Only instrumented EEPROMs pay for the timing; the class is untouched.
+    for name in ("send_cmd", "read", "write", "wait_okay", "collect_read", "collect_write"):
+        setattr(eeprom, name, timed(stats, name, getattr(eeprom, name)))
+    for name in ("read_cmd", "write_cmd"):
+        setattr(eeprom, name, timed(stats, "encode", getattr(eeprom, name)))
+    eeprom.port = CountingPort(eeprom.port, stats)
+    return eeprom
+
+@contextmanager
+def phase(stats, name):
+    if stats is None:
+        yield
+    else:
+        with stats.phase(name):
+            yield
@@ -0,0 +1,121 @@
+from time import monotonic, sleep
+import json
+import struct
+
+MAGIC = b'EEPROM TRANSCRIPT 1\n'
+EVENT = struct.Struct(">BdI")
+TX, RX = 0, 1
+
+class TranscriptMismatch(Exception):
+    pass
+
+class RecordingPort():
+    # Passes everything through to the real port, logging each write and
+    # each read with its time since recording started.
+    def __init__(self, port, filename, meta=None):
+        self.port = port
+        self.log = open(filename, 'wb')
+        self.log.write(MAGIC + json.dumps(meta or {}).encode() + b'\n')
+        self.started = monotonic()
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    @property
+    def baudrate(self):
+        return self.port.baudrate
+
+    @baudrate.setter
+    def baudrate(self, rate):
+        self.port.baudrate = rate
+
+    def record(self, direction, data):
+        self.log.write(EVENT.pack(direction, monotonic() - self.started, len(data)) + bytes(data))
+        return data
+
+    def write(self, data):
+        self.record(TX, data)
+        return self.port.write(data)
+
+    def flush(self):
+        self.port.flush()
+        self.log.flush()
+
+    def readline(self):
+        return self.record(RX, self.port.readline())
+
+    def read(self, size=1):
+        return self.record(RX, self.port.read(size))
+
+    def close(self):
+        if not self.log.closed:
+            self.log.close()
+        self.port.close()
+
+def read_transcript(filename):
+    with open(filename, 'rb') as transcript:
+        if transcript.readline() != MAGIC:
+            raise ValueError("{} isn't a serial transcript.".format(filename))
+        meta = json.loads(transcript.readline())
+        events = []
+        header = transcript.read(EVENT.size)
+        while len(header) == EVENT.size:
+            direction, seconds, size = EVENT.unpack(header)
+            events.append((direction, seconds, transcript.read(size)))
+            header = transcript.read(EVENT.size)
+    return meta, events
+
+class ReplaySerial():
+    # Answers each read with the next recorded reply, as long after the
+    # latest write as it came originally; speed scales that delay, and 0
+    # replays as fast as the host can go.
+    def __init__(self, filename, speed=1.0, strict=True):
+        self.name = filename
+        self.meta, events = read_transcript(filename)
+        self.speed = speed
+        self.strict = strict
+        self.baudrate = self.meta.get("baudrate")
+        self.timeout = None
+        self.sent = b''.join(data for direction, seconds, data in events if direction == TX)
+        self.position = 0
+        self.replies = []
+        last_write = 0.0
+        for direction, seconds, data in events:
+            if direction == TX:
+                last_write = seconds
+            else:
+                self.replies.append((seconds - last_write, data))
+        self.replies.reverse()
+        self.last_write = monotonic()
+
+    def write(self, data):
+        expected = self.sent[self.position:self.position + len(data)]
+        if self.strict and expected != data:
+            raise TranscriptMismatch("Sent {} at byte {} of the transcript, expected {}.".format(bytes(data), self.position, expected))
+        self.position += len(data)
+        self.last_write = monotonic()
+        return len(data)
+
+    def reply(self):
+        if not self.replies:
+            return b''
+        delay, data = self.replies.pop()
+        wait = self.last_write + delay * self.speed - monotonic()
+        if wait > 0:
+            sleep(wait)
+        return data
+
+    def readline(self):
+        return self.reply()
+
+    def read(self, size=1):
+        return self.reply()
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,73 @@
+import json
+from .writer import address_field
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BLOCK_SIZE = 256
+MAX_LISTED_RANGES = 16
+
+def diff_ranges(start, actual, expected):
+    if numpy is not None:
+        return numpy_diff_ranges(start, actual, expected)
+    return bytes_diff_ranges(start, actual, expected)
+
+def bytes_diff_ranges(start, actual, expected):
+    actual = memoryview(actual)
+    expected = memoryview(expected)
+    ranges = []
+    for offset in range(0, len(actual), BLOCK_SIZE):
+        block_end = min(offset + BLOCK_SIZE, len(actual))
+        if actual[offset:block_end] == expected[offset:block_end]:
+            continue
+        for i in range(offset, block_end):
+            if actual[i] != expected[i]:
+                if ranges and ranges[-1][1] == start + i:
+                    ranges[-1][1] += 1
+                else:
+                    ranges.append([start + i, start + i + 1])
+    return [tuple(r) for r in ranges]
+
+def numpy_diff_ranges(start, actual, expected):
+    mismatches = numpy.flatnonzero(numpy.frombuffer(actual, dtype=numpy.uint8) !=
+                                   numpy.frombuffer(expected, dtype=numpy.uint8))
+    if not len(mismatches):
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(mismatches) != 1)
+    firsts = numpy.concatenate((mismatches[:1], mismatches[breaks + 1]))
+    lasts = numpy.concatenate((mismatches[breaks], mismatches[-1:]))
+    return [(start + int(first), start + int(last) + 1) for first, last in zip(firsts, lasts)]
+
+def join_ranges(ranges):
+    joined = []
+    for start, end in ranges:
+        if joined and joined[-1][1] == start:
+            joined[-1] = (joined[-1][0], end)
+        else:
+            joined.append((start, end))
+    return joined
+
+def summarise(ranges, bytes_compared):
+    if not ranges:
+        return "Verify OK: {} bytes match.".format(bytes_compared)
+    bytes_differing = sum(end - start for start, end in ranges)
+    lines = ["Verify FAILED: {} of {} bytes differ in {} range{}.".format(
+        bytes_differing, bytes_compared, len(ranges), "" if len(ranges) == 1 else "s")]
+    for start, end in ranges[:MAX_LISTED_RANGES]:
+        lines.append("\t{}-{} ({} bytes)".format(address_field(start), address_field(end - 1), end - start))
+    if len(ranges) > MAX_LISTED_RANGES:
+        lines.append("\t... and {} more".format(len(ranges) - MAX_LISTED_RANGES))
+    return "\n".join(lines)
+
+def write_report(filename, start, ranges, bytes_compared, end=None):
+    report = {
+        "start": start,
+        "end": end if end is not None else start + bytes_compared,
+        "bytes_compared": bytes_compared,
+        "bytes_differing": sum(end - first for first, end in ranges),
+        "ranges": [{"start": first, "end": end} for first, end in ranges]
+    }
+    with open(filename, 'w') as output:
+        json.dump(report, output, indent=2)
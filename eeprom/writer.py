@@ -1,24 +1,82 @@
 from serial import Serial, SerialException
-import sys
+from binascii import unhexlify, Error as HexError
+from collections import deque
+from functools import lru_cache, reduce
+from itertools import islice
+from operator import xor
+from time import monotonic, sleep
 import struct
 
 OK = b'OK\r\n'
+ACK = b'\x06'
+READY_POLL_IN_SECS = 0.05
+READY_DEADLINE_IN_SECS = 5
+DEFAULT_RETRIES = 5
+INITIAL_BACKOFF_IN_SECS = 0.01
+ACK_DEADLINE_IN_SECS = 0.6
+MAX_BACKOFF_IN_SECS = 0.5
+RECORD_SIZE = 16
+RECORD_CACHE_SIZE = 4096
+COMPILE_BLOCK_RECORDS = 256
+SHORT_ADDRESS_LIMIT = 0x10000
+DEFAULT_BAUDRATE = 9600
+BAUDRATES = (1000000, 500000, 250000, 230400, 115200, 57600, 38400, 19200, 9600)
 
 class EEPROM():
     def __init__(self, rom_size=8192):
-        self.RECSIZE = 16
+        self.RECSIZE = RECORD_SIZE
         self.port = None
         self.rom_size = rom_size
+        self.window = 1
+        self.baudrate = DEFAULT_BAUDRATE
+        self.protocol = AsciiProtocol()
+        self.retries = 0
+        self.firmware_version = None
+        self.max_retries = DEFAULT_RETRIES
+        self.backoff = INITIAL_BACKOFF_IN_SECS
+        self.ack_deadline = ACK_DEADLINE_IN_SECS
     
-    def open_port(self, tty_port="/dev/tty.usbserial-1420"):
+    def open_port(self, tty_port="/dev/tty.usbserial-1420", baudrate=DEFAULT_BAUDRATE):
+        self.baudrate = baudrate
         if isinstance(tty_port, str):
             try:
-                self.port = Serial(tty_port, timeout=0.1, dsrdtr=True)
+                self.port = Serial(tty_port, baudrate=baudrate, timeout=0.1, dsrdtr=True)
             except SerialException as err:
                 raise EEPROMException(err)
         else:
             self.port = tty_port
     
+    def set_window(self, window):
+        self.window = max(1, int(window))
+    
+    def set_retry_policy(self, max_retries, backoff=INITIAL_BACKOFF_IN_SECS):
+        self.max_retries = max(0, int(max_retries))
+        self.backoff = backoff
+    
+    def set_ack_deadline(self, deadline):
+        self.ack_deadline = max(0.0, float(deadline))
+    
+    def set_protocol(self, protocol):
+        self.protocol = protocol
+    
+    def supports(self, feature):
+        if self.firmware_version is None:
+            self.version()
+        return feature in firmware_features(self.firmware_version or "")
+    
+    def negotiate_extended(self):
+        if not self.supports("+EXT"):
+            raise EEPROMUnsupported("Programmer firmware can't address more than 64K.")
+        self.protocol = ExtendedAsciiProtocol()
+        return self.protocol
+    
+    def negotiate_binary(self):
+        if "+BIN" in firmware_features(self.version()):
+            self.protocol = BinaryProtocol()
+        else:
+            self.protocol = AsciiProtocol()
+        return self.protocol
+    
     def __del__(self):
         self.close()
     
@@ -27,55 +85,346 @@ class EEPROM():
             self.port.close()
     
     def read(self, addr):
-        cmd = str.encode("R" + address_field(addr) + chr(10))
+        return self.retry(self.read_once, addr)
+    
+    def write(self, addr, data):
+        return self.retry(self.write_once, addr, data)
+    
+    def read_once(self, addr):
+        cmd = self.read_cmd(addr)
         self.send_cmd(cmd)
-        response = self.port.readline().upper()
+        response = self.await_reply(self.protocol.read_response)
+        if not response:
+            raise EEPROMTimeout("No response to read at {}.".format(address_field(addr)))
+        if not self.protocol.matches(addr, response):
+            raise EEPROMGarbled("Unexpected response to read at {}: {}".format(address_field(addr), response))
+        self.protocol.decode(addr, response)
         self.wait_okay()
         return response
     
-    def write(self, addr, data):
-        cmd = str.encode("W" + address_field(addr) + ":" + data_field(data) + chr(10))
+    def write_once(self, addr, data):
+        cmd = self.write_cmd((addr, data))
         self.send_cmd(cmd)
         self.wait_okay()
         return cmd
     
+    def retry(self, attempt, *args):
+        delay = self.backoff
+        tries = 0
+        while True:
+            try:
+                return attempt(*args)
+            except EEPROMException:
+                if tries >= self.max_retries:
+                    raise
+            tries += 1
+            self.retries += 1
+            sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF_IN_SECS)
+            # Throw away the rest of the failed exchange before resending
+            self.drain()
+    
+    def range_crc(self, start, end):
+        return self.retry(self.range_crc_once, start, end)
+    
+    def range_crc_once(self, start, end):
+        # CRC-32 of [start, end) worked out by the firmware, so a verify only
+        # has to move the checksum over the wire rather than the data.
+        span = self.protocol.address(start) + "-" + self.protocol.address(end - 1)
+        self.send_cmd(str.encode("C" + span + chr(10)))
+        response = self.port.readline().upper()
+        if not response:
+            raise EEPROMTimeout("No response to checksum of {}.".format(span))
+        try:
+            if not response.startswith(str.encode(span + ":")):
+                raise ValueError()
+            return int(response[len(span) + 1:len(span) + 9], 16)
+        except ValueError:
+            raise EEPROMGarbled("Unexpected response to checksum of {}: {}".format(span, response))
+    
+    def read_range(self, start, end):
+        addresses = range(start, end, self.RECSIZE)
+        data = bytearray(len(addresses) * self.RECSIZE)
+        offset = 0
+        for addr, record in self.iter_range(start, end):
+            data[offset:offset + self.RECSIZE] = record
+            offset += self.RECSIZE
+        return data
+    
+    def iter_range(self, start, end):
+        for addr, response in self.read_records(range(start, end, self.RECSIZE)):
+            yield addr, self.protocol.decode(addr, response)
+    
+    def read_records(self, addresses):
+        if self.window < 2:
+            for addr in addresses:
+                yield addr, self.read(addr)
+        else:
+            yield from self.pipeline(((addr, self.read_cmd(addr)) for addr in addresses), self.collect_read,
+                                     lambda addr: (addr, self.read(addr)))
+    
+    def write_records(self, records):
+        if self.window < 2:
+            for addr, data in records:
+                yield addr, self.write(addr, data)
+        else:
+            yield from self.pipeline(self.compile_writes(records), self.collect_write,
+                                     lambda record: (record[0], self.write(*record)))
+    
+    def compile_writes(self, records):
+        # Encode a block of records at a time ahead of sending them, so the
+        # transfer loop only moves bytes but big images never sit in memory
+        # as a whole list of commands.
+        records = iter(records)
+        block = list(islice(records, COMPILE_BLOCK_RECORDS))
+        while block:
+            yield from [(record, self.write_cmd(record)) for record in block]
+            block = list(islice(records, COMPILE_BLOCK_RECORDS))
+    
+    def pipeline(self, commands, collect, lock_step):
+        end = object()
+        in_flight = deque()
+        commands = iter(commands)
+        items = (item for item, cmd in commands)
+        while True:
+            # Top up once half the window has drained, as one write to the port
+            if len(in_flight) <= self.window // 2:
+                batch = []
+                while len(in_flight) < self.window:
+                    command = next(commands, end)
+                    if command is end:
+                        break
+                    in_flight.append(command)
+                    batch.append(command[1])
+                if batch:
+                    self.send_cmd(b''.join(batch))
+            if not in_flight:
+                return
+            response = collect(*in_flight[0])
+            if response is None:
+                break
+            in_flight.popleft()
+            yield response
+        # First bad response: drop whatever is still on the line and resend
+        # every unacknowledged command lock-step from here on.
+        self.window = 1
+        self.drain()
+        for item, cmd in in_flight:
+            yield lock_step(item)
+        for item in items:
+            yield lock_step(item)
+    
+    def read_cmd(self, addr):
+        return self.protocol.read_cmd(addr)
+    
+    def write_cmd(self, record):
+        return self.protocol.write_cmd(*record)
+    
+    def collect_read(self, addr, cmd):
+        response = self.await_reply(self.protocol.read_response)
+        if not self.protocol.matches(addr, response):
+            return None
+        try:
+            self.protocol.decode(addr, response)
+        except EEPROMException:
+            # Bad record: let the pipeline fall back and read it again
+            return None
+        if self.await_reply(self.protocol.read_ack) != self.protocol.OK:
+            return None
+        return addr, response
+    
+    def collect_write(self, record, cmd):
+        if self.await_reply(self.protocol.read_ack) != self.protocol.OK:
+            return None
+        return record[0], cmd
+    
+    def drain(self):
+        while self.port.readline():
+            pass
+    
+    def await_reply(self, read):
+        # A slow write can outlast several port timeouts, so silence only
+        # counts once the acknowledge deadline has passed.
+        give_up = monotonic() + self.ack_deadline
+        reply = read(self.port)
+        while not reply and monotonic() < give_up:
+            reply = read(self.port)
+        return reply
+    
     def wait_okay(self):
-        retries = 0
-        resp = self.port.readline()
-        while resp != OK:
-            print("RESP:", resp)
-            retries += 1
-            if retries > 5:
-                self.port.close()
-                sys.exit("Didn't receive OK back from programmer.\n")
-            resp = self.port.readline()
+        skipped = 0
+        resp = self.await_reply(self.protocol.read_ack)
+        while resp != self.protocol.OK:
+            if not resp:
+                raise EEPROMTimeout("Didn't receive OK back from programmer.")
+            skipped += 1
+            if skipped > 5:
+                raise EEPROMGarbled("Didn't receive OK back from programmer, last response was {}.".format(resp))
+            resp = self.await_reply(self.protocol.read_ack)
     
     def version(self):
         cmd = str.encode("V" + chr(10))
         self.send_cmd(cmd)
-        response = self.port.readline().upper()
-        return response.decode('UTF-8')
+        response = self.port.readline().upper().decode('UTF-8', errors='replace')
+        if valid_version(response):
+            self.firmware_version = response.strip()
+        return response
+    
+    def wait_until_ready(self, deadline):
+        give_up = monotonic() + deadline
+        response = self.version()
+        while not valid_version(response):
+            if monotonic() >= give_up:
+                raise EEPROMTimeout("Programmer didn't answer within {} seconds.".format(deadline))
+            sleep(READY_POLL_IN_SECS)
+            response = self.version()
+        self.reset_input()
+        return response
+    
+    def probe_baudrate(self, rates, deadline):
+        give_up = monotonic() + deadline
+        while True:
+            for rate in rates:
+                self.port.baudrate = rate
+                self.reset_input()
+                if valid_version(self.version()):
+                    self.reset_input()
+                    self.baudrate = rate
+                    return rate
+            if monotonic() >= give_up:
+                raise EEPROMTimeout("Programmer didn't answer at any baud rate within {} seconds.".format(deadline))
+            sleep(READY_POLL_IN_SECS)
+    
+    def reset_input(self):
+        # Drop any answers to earlier probes that turned up late
+        if hasattr(self.port, "reset_input_buffer"):
+            self.port.reset_input_buffer()
     
     def send_cmd(self, cmd):
         self.port.write(cmd)
         self.port.flush()
 
+class AsciiProtocol():
+    name = "ascii"
+    OK = OK
+    ADDRESS_DIGITS = 4
+    
+    def address(self, addr):
+        return "%0*X" % (self.ADDRESS_DIGITS, addr)
+    
+    def read_cmd(self, addr):
+        return str.encode("R" + self.address(addr) + chr(10))
+    
+    def write_cmd(self, addr, data):
+        return b'W' + str.encode(self.address(addr)) + encoded_record(bytes(data))
+    
+    def read_response(self, port):
+        return port.readline().upper()
+    
+    def read_ack(self, port):
+        return port.readline()
+    
+    def matches(self, addr, response):
+        return response.startswith(str.encode(self.address(addr) + ":"))
+    
+    def decode(self, addr, response):
+        return decode_record(addr, response, self.ADDRESS_DIGITS)
+
+class ExtendedAsciiProtocol(AsciiProtocol):
+    # Same commands with 24-bit addresses, for parts bigger than 64K
+    name = "ascii24"
+    ADDRESS_DIGITS = 6
+
+class BinaryProtocol():
+    # Commands are: op, length, big-endian address, payload, XOR checksum
+    # over everything after the op. A read carries no payload, its length is
+    # the number of bytes wanted; the reply is the same frame without the op.
+    # Every command is acknowledged with a single ACK byte.
+    name = "binary"
+    OK = ACK
+    RECSIZE = 16
+    
+    def address(self, addr):
+        # For the ASCII commands that have no binary frame, such as C
+        return address_field(addr)
+    
+    def read_cmd(self, addr):
+        body = struct.pack(">BH", self.RECSIZE, addr)
+        return b'r' + body + bytes([checksum(body)])
+    
+    def write_cmd(self, addr, data):
+        data = bytes(data) + b'\xff' * (self.RECSIZE - len(data))
+        return b'w' + frame(addr, data[:self.RECSIZE])
+    
+    def read_response(self, port):
+        header = port.read(3)
+        if len(header) < 3:
+            return header
+        return header + port.read(header[0] + 1)
+    
+    def read_ack(self, port):
+        return port.read(1)
+    
+    def matches(self, addr, response):
+        return len(response) >= 3 and struct.unpack(">H", response[1:3])[0] == addr
+    
+    def decode(self, addr, response):
+        if not self.matches(addr, response) or len(response) != response[0] + 4:
+            raise EEPROMGarbled("Malformed frame at {}: {}".format(address_field(addr), response))
+        if checksum(response[:-1]) != response[-1]:
+            raise EEPROMChecksumError("Checksum mismatch in record at {}".format(address_field(addr)))
+        return response[3:-1]
+
+def frame(addr, payload):
+    body = struct.pack(">BH", len(payload), addr) + payload
+    return body + bytes([checksum(body)])
+
+def checksum(data):
+    return reduce(xor, data, 0)
+
+def firmware_features(version):
+    return set(word for word in version.upper().split() if word.startswith("+"))
+
 def address_field(addr):
     return ("%04x" % addr).upper()
 
 def data_field(data):
-    chksum = 0
-    payload = ""
-    for byte in data:
-        payload += ("%02x" % byte)
-        chksum = chksum ^ byte
-    payload += "ffffffffffffffffffffffffffffffff"
-    payload = payload[:32]
-    if (len(data) & 1):
-        chksum = chksum ^ 255
-    chksum = chksum & 255
-    payload += "," + ("%02x" % chksum)
-    return payload.upper()
+    # Short records are padded with FF, which the checksum has to include too
+    chksum = checksum(data) ^ (255 if len(data) & 1 else 0)
+    payload = (bytes(data[:16]) + b'\xff' * (16 - len(data))).hex()
+    return (payload + "," + ("%02x" % chksum)).upper()
+
+@lru_cache(maxsize=RECORD_CACHE_SIZE)
+def encoded_record(data):
+    # Images repeat records a lot (blank FF runs especially), so the write
+    # command body is shared between them.
+    return str.encode(":" + data_field(data) + chr(10))
+
+def valid_version(response):
+    response = response.strip()
+    return bool(response) and response.isascii() and response.isprintable()
+
+def decode_record(addr, response, address_digits=4):
+    try:
+        data = unhexlify(response[address_digits + 1:address_digits + 33])
+        chksum = int(response[address_digits + 34:address_digits + 36], 16)
+    except (HexError, ValueError):
+        raise EEPROMGarbled("Malformed record at {}: {}".format(address_field(addr), response))
+    if checksum(data) != chksum:
+        raise EEPROMChecksumError("Checksum mismatch in record at {}".format(address_field(addr)))
+    return data
 
 class EEPROMException(Exception):
+    pass
+
+class EEPROMTimeout(EEPROMException):
+    pass
+
+class EEPROMGarbled(EEPROMException):
+    pass
+
+class EEPROMChecksumError(EEPROMException):
+    pass
+
+class EEPROMUnsupported(EEPROMException):
     pass
\ No newline at end of file
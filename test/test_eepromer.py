@@ -1,11 +1,26 @@
-from eeprom.writer import EEPROM
-from eeprom.programmer import Programmer
-from eeprom.main import main
+from eeprom.writer import EEPROM, EEPROMException, EEPROMTimeout, EEPROMGarbled, EEPROMChecksumError, EEPROMUnsupported, OK, data_field, AsciiProtocol, BinaryProtocol
+from eeprom.programmer import Programmer, read_rom_from_file
+from eeprom.main import main, run, open_eeprom, daemon_job, parse_args
+from eeprom.session import Session
+from eeprom.transcript import RecordingPort, ReplaySerial, TranscriptMismatch
+from eeprom.shadow import ShadowCache
+from eeprom.daemon import DaemonRunning, JobServer, submit, client_args
+from eeprom.gang import gang_program
+from eeprom.stats import Stats, Histogram, instrument
+from eeprom.benchmark import end_to_end_benchmarks, print_results, replay_benchmark
+from eeprom.fake_serial import FakeSerial
+from eeprom.ranges import parse_ranges, merge_ranges
+from eeprom.hexfile import ImageFormatError, load_segments
+from eeprom.verify import bytes_diff_ranges, numpy_diff_ranges, summarise
 from io import StringIO, BytesIO
 import pytest
 import os
+import json
+import time
+import threading
+import socket
 
-usage_string = """Usage: eeprom [ -V | -r | -w | -d] [-v] [-s n] [-e n] [-p port] [-S n] rom_file
+usage_string = """Usage: eeprom [ -V | -r | -w | -d] [-v] [-s n] [-e n] [-p port] [-S n] [-P n] [-T n] [-A n] [-R n] [-B n] [-b] [--diff-write] [--verify-report file] [--stats | --stats-json] [--resume] [--range s-e,...] [--range-file file] [-C] [--crc-verify] [--blank-check] [--skip-blank] [--chip-id id [--trust-cache] [--cache-dir dir]] [--record file | --replay file [--replay-speed x]] [--daemon socket | --socket socket] rom_file
 Where:
     -V - print EEPROM writer firmware version
     -r - read EEPROM contents and print as hex (default option)
@@ -14,14 +29,39 @@ Where:
     -v - verify contents of EEPROM with ROM file (default is False)
     -s - start address (default is 0
     -e - end address
-    -p - USB port tty (default is /dev/tty.usbserial-1420
+    -p - USB port tty (default is /dev/tty.usbserial-1420, repeat to gang program)
     -S - EEPROM size in K (default is 8)
+    -P - number of commands kept in flight (default is 1, no pipelining)
+    -T - seconds to wait for the programmer to answer (default is 5)
+    -A - seconds to wait for the programmer to acknowledge a command (default is 0.6)
+    -R - times to resend a failed command before giving up (default is 5)
+    -B - serial baud rate, or auto to probe for the fastest (default is 9600)
+    -b - use the binary protocol if the firmware supports it
+    -C - print EEPROM contents in hexdump -C format
+    --diff-write - only write records that differ from the EEPROM contents
+    --verify-report - write a JSON report of verify differences to file
+    --stats - print transfer statistics when done
+    --stats-json - print transfer statistics as JSON when done
+    --resume - continue an interrupted write from its journal
+    --range - address ranges to process as start-end, comma separated or repeated
+    --range-file - read address ranges from file, one or more per line
+    --crc-verify - verify with the programmer's range checksum when the firmware has one
+    --blank-check - check the EEPROM is all FF, and don't write to it if not
+    --skip-blank - when writing to a blank EEPROM, skip records that are all FF
+    --chip-id - keep a shadow copy of the EEPROM with this ID in the cache
+    --trust-cache - use the shadow copy instead of reading parts known to match
+    --cache-dir - directory for shadow copies (default is ~/.cache/eepromer)
+    --record - record everything sent to and read from the programmer in file
+    --replay - play a recorded session back instead of using a programmer
+    --replay-speed - replay timing scale, 0 for as fast as possible (default is 1)
+    --daemon - keep the port open and run jobs sent to the unix socket
+    --socket - send this job to the daemon listening on the unix socket
     rom_file - ROM file to write or verify against
 """
 
-class MockEEPROM():
+class MockEEPROM(EEPROM):
     def __init__(self, rom_size=8192):
-        self.rom_size = rom_size
+        super().__init__(rom_size)
     
     def read(self, addr):
         addr = ("%04x" % addr).upper()
@@ -52,6 +92,58 @@ class MockSerial():
     def flush(self):
         pass
 
+class ScriptedSerial(MockSerial):
+    def __init__(self, replies):
+        super().__init__()
+        self.replies = list(replies)
+
+    def readline(self):
+        return self.replies.pop(0) if self.replies else b''
+
+class StatefulSerial():
+    def __init__(self, rom_size=8192, garble=(), name="stateful"):
+        self.name = name
+        self.memory = bytearray(b'\xff' * rom_size)
+        self.garble = set(garble)
+        self.commands = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.pending = b''
+        self.responses = []
+
+    def readline(self):
+        if not self.responses:
+            return b''
+        self.in_flight -= 1
+        return self.responses.pop(0)
+
+    def close(self):
+        pass
+
+    def write(self, data):
+        self.pending += data
+        while b'\n' in self.pending:
+            line, self.pending = self.pending.split(b'\n', 1)
+            self.execute(line.decode())
+
+    def flush(self):
+        pass
+
+    def execute(self, line):
+        self.commands += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        addr = int(line[1:5], 16)
+        if line[0] == "W":
+            self.memory[addr:addr + 16] = bytes.fromhex(line[6:38])
+        else:
+            data = self.memory[addr:addr + 16]
+            self.responses.append(("%04X:%s\r\n" % (addr, data_field(data))).encode())
+        if self.commands in self.garble:
+            self.responses.append(b'O?\r\n')
+        else:
+            self.responses.append(OK)
+
 def test_eeprom_writer_version():
     test_port = MockSerial(b"EEPROM VERSION=TEST\n")
     eeprom = EEPROM()
@@ -60,13 +152,97 @@ def test_eeprom_writer_version():
     print(response)
     assert response == "EEPROM VERSION=TEST\n"
 
+def test_eeprom_wait_until_ready_polls_version():
+    test_port = MockSerial(b"\n\nEEPROM VERSION=TEST\n")
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    response = eeprom.wait_until_ready(1)
+    assert response == "EEPROM VERSION=TEST\n"
+    assert test_port.in_stream.getvalue() == b"V\nV\nV\n"
+
+def test_eeprom_wait_until_ready_ignores_line_noise():
+    test_port = MockSerial(b"\x00\xfe\r\nEEPROM VERSION=TEST\n")
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    response = eeprom.wait_until_ready(1)
+    assert response == "EEPROM VERSION=TEST\n"
+    assert test_port.in_stream.getvalue() == b"V\nV\n"
+
+def test_eeprom_wait_until_ready_gives_up_after_deadline():
+    test_port = MockSerial()
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    with pytest.raises(EEPROMTimeout):
+        eeprom.wait_until_ready(0.2)
+
+class BaudSerial(MockSerial):
+    def __init__(self, firmware_rate):
+        super().__init__()
+        self.firmware_rate = firmware_rate
+        self.baudrate = 9600
+        self.tried = []
+
+    def readline(self):
+        self.tried.append(self.baudrate)
+        if self.baudrate == self.firmware_rate:
+            return b"EEPROM VERSION=TEST\n"
+        return b"\x8f\xfe\x00\n"
+
+def test_eeprom_probe_baudrate_picks_fastest_answering_rate():
+    test_port = BaudSerial(57600)
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    assert eeprom.probe_baudrate([115200, 57600, 9600], 1) == 57600
+    assert eeprom.baudrate == 57600
+    assert test_port.tried == [115200, 57600]
+
+def test_eeprom_probe_baudrate_gives_up_after_deadline():
+    test_port = BaudSerial(300)
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    with pytest.raises(EEPROMTimeout):
+        eeprom.probe_baudrate([115200, 9600], 0.1)
+
+def test_main_arg_parsing_baudrate():
+    result = StringIO()
+    with pytest.raises(SystemExit):
+        main(result, ["", "-B", "fast"])
+    assert result.getvalue() == "invalid literal for int() with base 10: 'fast'\n" + usage_string
+
 def test_eeprom_writer_read():
-    test_port = MockSerial(b"FFFF\nOK\r\n")
+    test_port = MockSerial(b"0000:FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF,00\r\nOK\r\n")
     eeprom = EEPROM()
     eeprom.open_port(test_port)
     response = eeprom.read(0)
     print(response)
-    assert response == b"FFFF\n"
+    assert response == b"0000:FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF,00\r\n"
+
+def test_eeprom_read_retries_garbled_record():
+    test_port = ScriptedSerial([b"0000:FFFF\r\n", b"OK\r\n", b"",
+                                b"0000:FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF,00\r\n", b"OK\r\n"])
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    assert eeprom.read(0) == b"0000:FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF,00\r\n"
+    assert eeprom.retries == 1
+    assert test_port.in_stream.getvalue() == b"R0000\nR0000\n"
+
+def test_eeprom_read_gives_up_with_typed_exception():
+    test_port = ScriptedSerial([b"0000:FFFF\r\n", b"OK\r\n", b""] * 3)
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    eeprom.set_retry_policy(2, backoff=0)
+    with pytest.raises(EEPROMGarbled):
+        eeprom.read(0)
+    assert test_port.in_stream.getvalue() == b"R0000\n" * 3
+
+def test_eeprom_write_reports_stray_replies_in_exception_only(capsys):
+    test_port = MockSerial(b"ERR\r\n" * 6)
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    eeprom.set_retry_policy(0)
+    with pytest.raises(EEPROMGarbled, match="ERR"):
+        eeprom.write(0, b'\x00')
+    assert capsys.readouterr().out == ""
 
 def test_eeprom_writer_write_without_parity():
     test_port = MockSerial(b"FFFF\nOK\r\n")
@@ -90,10 +266,142 @@ def test_eeprom_writer_write_fails_when_no_OK():
     test_port = MockSerial()
     eeprom = EEPROM()
     eeprom.open_port(test_port)
-    with pytest.raises(SystemExit):
+    with pytest.raises(EEPROMTimeout):
         response = eeprom.write(0,b'HELLO\n')
 
 
+def test_eeprom_write_waits_for_slow_OK():
+    test_port = FakeSerial(BytesIO(), timeout=0.1, throttle=True, write_latency=0.15)
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    eeprom.write(0, b'\x01' * 16)
+    assert eeprom.retries == 0
+    assert test_port.memory[0:16] == b'\x01' * 16
+    eeprom.set_ack_deadline(0)
+    eeprom.set_retry_policy(0)
+    with pytest.raises(EEPROMTimeout):
+        eeprom.write(16, b'\x02' * 16)
+
+def test_eeprom_read_range_decodes_records():
+    test_port = StatefulSerial()
+    test_port.memory[0:32] = bytes(range(3, 35))
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    data = eeprom.read_range(0, 32)
+    assert data == bytearray(range(3, 35))
+
+def test_eeprom_read_range_rejects_bad_checksum():
+    test_port = MockSerial(b"0000:41414141414141414141414141414141,01\r\nOK\r\n")
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    with pytest.raises(EEPROMException):
+        eeprom.read_range(0, 16)
+
+def test_eeprom_pipelined_write_keeps_commands_in_flight():
+    test_port = StatefulSerial()
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    eeprom.set_window(4)
+    records = [(addr, bytes([addr >> 4]) * 16) for addr in range(0, 128, 16)]
+    written = [addr for addr, cmd in eeprom.write_records(records)]
+    assert written == list(range(0, 128, 16))
+    assert test_port.max_in_flight == 4
+    assert test_port.memory[:128] == b''.join(data for addr, data in records)
+
+def test_eeprom_pipelined_read_matches_responses_to_addresses():
+    test_port = StatefulSerial()
+    test_port.memory[0:64] = bytes(range(64))
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    eeprom.set_window(3)
+    records = list(eeprom.read_records(range(0, 64, 16)))
+    assert [addr for addr, record in records] == [0, 16, 32, 48]
+    assert records[2][1] == b'0020:202122232425262728292A2B2C2D2E2F,00\r\n'
+    assert test_port.max_in_flight == 3
+
+def test_eeprom_pipelined_read_recovers_from_bad_checksum():
+    test_port = FakeSerial(bad_checksum=[2])
+    test_port.memory[0:64] = bytes(range(64))
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    eeprom.set_window(4)
+    assert eeprom.read_range(0, 64) == bytes(range(64))
+    assert eeprom.window == 1
+
+def test_eeprom_pipeline_falls_back_to_lock_step_on_error():
+    test_port = StatefulSerial(garble=[2])
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    eeprom.set_window(4)
+    records = [(addr, b'\x55' * 16) for addr in range(0, 96, 16)]
+    written = [addr for addr, cmd in eeprom.write_records(records)]
+    assert written == list(range(0, 96, 16))
+    assert eeprom.window == 1
+    assert test_port.memory[:96] == b'\x55' * 96
+
+def test_eeprom_negotiates_binary_protocol_from_version():
+    eeprom = EEPROM()
+    eeprom.open_port(FakeSerial(BytesIO()))
+    assert isinstance(eeprom.negotiate_binary(), BinaryProtocol)
+
+def test_eeprom_falls_back_to_ascii_without_binary_support():
+    eeprom = EEPROM()
+    eeprom.open_port(MockSerial(b"EEPROM VERSION=TEST\n"))
+    assert isinstance(eeprom.negotiate_binary(), AsciiProtocol)
+
+def test_eeprom_binary_protocol_write_and_read():
+    serial_log = BytesIO()
+    eeprom = EEPROM()
+    eeprom.open_port(FakeSerial(serial_log))
+    eeprom.set_protocol(BinaryProtocol())
+    eeprom.set_window(2)
+    list(eeprom.write_records([(0x1230, b'A')]))
+    assert serial_log.getvalue() == b'w\x10\x12\x30A' + b'\xff' * 15 + b'\x8c'
+    assert eeprom.read_range(0x20, 0x40) == b'\xff' * 32
+
+def test_binary_protocol_rejects_bad_checksum():
+    with pytest.raises(EEPROMException):
+        BinaryProtocol().decode(0, b'\x01\x00\x00\x41\x00')
+
+def test_emulator_stores_written_records():
+    emulator = FakeSerial(rom_size=1024)
+    eeprom = EEPROM(1024)
+    eeprom.open_port(emulator)
+    list(eeprom.write_records([(16, b'\x01\x02\x03')]))
+    assert emulator.memory[16:20] == b'\x01\x02\x03\xff'
+    assert eeprom.read_range(0, 32) == b'\xff' * 16 + b'\x01\x02\x03' + b'\xff' * 13
+
+def test_emulator_injects_bad_checksums():
+    eeprom = EEPROM()
+    eeprom.open_port(FakeSerial(bad_checksum=[2]))
+    eeprom.set_retry_policy(0)
+    with pytest.raises(EEPROMChecksumError):
+        eeprom.read_range(0, 48)
+
+def test_emulator_injects_dropped_oks():
+    eeprom = EEPROM()
+    eeprom.open_port(FakeSerial(drop_ok=[1]))
+    eeprom.set_retry_policy(0)
+    with pytest.raises(EEPROMTimeout):
+        eeprom.write(0, b'\x00')
+
+def test_eeprom_retries_only_the_failed_record():
+    emulator = FakeSerial(bad_checksum=[2], drop_ok=[4])
+    eeprom = EEPROM()
+    eeprom.open_port(emulator)
+    assert eeprom.read_range(0, 48) == b'\xff' * 48
+    list(eeprom.write_records([(0, b'\x01')]))
+    assert eeprom.retries == 2
+    assert emulator.commands == 6
+
+def test_emulator_throttles_to_line_rate():
+    eeprom = EEPROM()
+    eeprom.open_port(FakeSerial(baudrate=9600, throttle=True))
+    started = time.monotonic()
+    eeprom.read_range(0, 64)
+    # 4 x (6 byte command + 46 byte response) at 960 bytes per second
+    assert time.monotonic() - started >= 0.2
+
 def test_programmer_version_returned_for_invalid_start():
     eeprom = MockEEPROM()
     result = StringIO()
@@ -112,7 +420,7 @@ def test_programmer_read_0_15_bytes():
 
     programmer.read_eeprom() 
     assert result.getvalue() == """Reading EEPROM from 0 to 15
-0000:41414141414141414141414141414141,00\r\n
+0000:41414141414141414141414141414141,00
 """
 
 def test_programmer_read_16_31_bytes():
@@ -124,7 +432,7 @@ def test_programmer_read_16_31_bytes():
 
     programmer.read_eeprom()
     assert result.getvalue() == """Reading EEPROM from 16 to 31
-0010:41414141414141414141414141414141,00\r\n
+0010:41414141414141414141414141414141,00
 """
 
 def test_programmer_read_0_31_bytes():
@@ -137,8 +445,8 @@ def test_programmer_read_0_31_bytes():
     programmer.read_eeprom()
     print(result.getvalue())
     assert result.getvalue() == """Reading EEPROM from 0 to 31
-0000:41414141414141414141414141414141,00\r\n
-0010:41414141414141414141414141414141,00\r\n
+0000:41414141414141414141414141414141,00
+0010:41414141414141414141414141414141,00
 """
 
 def test_programmer_read_verify_0_64_bytes_fails_with_smaller_file():
@@ -167,6 +475,7 @@ def test_programmer_read_verify_0_31_bytes():
     assert result.getvalue() == """ROM file is {} bytes long.
 Reading EEPROM from 0 to 31
 Verifying...
+Verify OK: 32 bytes match.
 """.format(os.path.getsize(test_input))
 
 def test_programmer_read_verify_0_31_bytes_fail():
@@ -184,15 +493,49 @@ def test_programmer_read_verify_0_31_bytes_fail():
     assert result.getvalue() == """ROM file is {} bytes long.
 Reading EEPROM from 0 to 31
 Verifying...
-DIFF:
-	ROM :0: 41 41 41 41 41 41 41 41 41 41 41 41 41 41 41 41
-	FILE:0: 42 42 42 42 42 42 42 42 42 42 42 42 42 42 42 42
+Verify FAILED: 32 of 32 bytes differ in 1 range.
+	0000-001F (32 bytes)
+""".format(os.path.getsize(test_input))
 
-DIFF:
-	ROM :16: 41 41 41 41 41 41 41 41 41 41 41 41 41 41 41 41
-	FILE:16: 42 42 42 42 42 42 42 42 42 42 42 42 42 42 42 42
+def test_diff_ranges_coalesces_mismatches():
+    actual = bytearray(b'\x00' * 600)
+    actual[3:5] = b'\x01\x01'
+    actual[250:260] = b'\x02' * 10
+    actual[599] = 3
+    assert bytes_diff_ranges(16, actual, b'\x00' * 600) == [(19, 21), (266, 276), (615, 616)]
 
-""".format(os.path.getsize(test_input))
+def test_numpy_diff_ranges_matches_bytes_diff_ranges():
+    pytest.importorskip("numpy")
+    actual = bytearray(b'\x00' * 600)
+    actual[250:260] = b'\x02' * 10
+    actual[599] = 3
+    expected = bytes(600)
+    assert numpy_diff_ranges(0, actual, expected) == bytes_diff_ranges(0, actual, expected)
+
+def test_summarise_limits_listed_ranges():
+    ranges = [(i * 2, i * 2 + 1) for i in range(20)]
+    summary = summarise(ranges, 64).split("\n")
+    assert summary[0] == "Verify FAILED: 20 of 64 bytes differ in 20 ranges."
+    assert summary[-1] == "\t... and 4 more"
+    assert len(summary) == 18
+
+def test_programmer_verify_writes_json_report():
+    test_report = "test/report.json"
+    eeprom = MockEEPROM()
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(16)
+    programmer.set_end(32)
+    programmer.set_input_rom("test/testB.rom")
+    programmer.set_verify(True)
+    programmer.set_verify_report(test_report)
+
+    programmer.read_eeprom()
+    with open(test_report) as report_file:
+        report = json.load(report_file)
+    os.remove(test_report)
+    assert report == {"start": 16, "end": 32, "bytes_compared": 16, "bytes_differing": 16,
+                      "ranges": [{"start": 16, "end": 32}]}
 
 def test_programmer_write_0_31_bytes():
     test_input = "test/testA.rom"
@@ -223,6 +566,7 @@ def test_programmer_write_verify_0_31_bytes():
     print(result.getvalue())
     assert result.getvalue() == """ROM file is {} bytes long.
 Writing ROM test/testA.rom to EEPROM.
+Verify OK: 32 bytes match.
 """.format(os.path.getsize(test_input))
 
 
@@ -240,15 +584,130 @@ def test_programmer_write_verify_0_31_bytes_fails():
     print(result.getvalue())
     assert result.getvalue() == """ROM file is {} bytes long.
 Writing ROM {} to EEPROM.
-DIFF:
-	ROM :0: 41 41 41 41 41 41 41 41 41 41 41 41 41 41 41 41
-	FILE:0: 42 42 42 42 42 42 42 42 42 42 42 42 42 42 42 42
+Verify FAILED: 32 of 32 bytes differ in 1 range.
+	0000-001F (32 bytes)
+""".format(os.path.getsize(test_input), test_input)
 
-DIFF:
-	ROM :16: 41 41 41 41 41 41 41 41 41 41 41 41 41 41 41 41
-	FILE:16: 42 42 42 42 42 42 42 42 42 42 42 42 42 42 42 42
+def test_programmer_diff_write_skips_unchanged_records():
+    test_input = "test/testA.rom"
+    eeprom = MockEEPROM()
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(0)
+    programmer.set_end(31)
+    programmer.set_input_rom(test_input)
+    programmer.set_diff_write(True)
 
-""".format(os.path.getsize(test_input), test_input)
+    programmer.write_eeprom()
+    assert result.getvalue() == """ROM file is {} bytes long.
+Writing ROM test/testA.rom to EEPROM.
+Skipped 2 unchanged records, wrote 0.
+""".format(os.path.getsize(test_input))
+
+def test_programmer_diff_write_only_sends_changed_records():
+    test_port = StatefulSerial()
+    test_port.memory[0:16] = b'\x42' * 16
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(0)
+    programmer.set_end(32)
+    programmer.set_input_rom("test/testB.rom")
+    programmer.set_diff_write(True)
+
+    programmer.write_eeprom()
+    assert result.getvalue().endswith("Skipped 1 unchanged records, wrote 1.\n")
+    assert test_port.commands == 3
+    assert test_port.memory[:32] == b'\x42' * 32
+
+def test_programmer_write_from_start_offset():
+    test_port = StatefulSerial()
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(32)
+    programmer.set_end(64)
+    programmer.set_input_rom("test/testB.rom")
+
+    programmer.write_eeprom()
+    assert test_port.memory[:32] == b'\xff' * 32
+    assert test_port.memory[32:64] == b'\x42' * 32
+
+def test_read_rom_from_file_maps_whole_image():
+    rom_size, rom = read_rom_from_file("test/testA.rom")
+    assert rom_size == 34
+    assert isinstance(rom, memoryview)
+    assert rom[32:48] == b'AA'
+
+def test_programmer_write_resumes_from_journal():
+    test_input = "test/testC.rom"
+    emulator = FakeSerial(drop_ok=[3])
+    eeprom = EEPROM()
+    eeprom.open_port(emulator)
+    programmer = Programmer(eeprom, StringIO())
+    programmer.set_start(0)
+    programmer.set_end(256)
+    programmer.set_input_rom(test_input)
+    eeprom.set_retry_policy(0)
+    with pytest.raises(EEPROMTimeout):
+        programmer.write_eeprom()
+    with open(test_input + ".journal") as journal:
+        assert json.load(journal)["confirmed"] == 32
+
+    emulator.drop_ok.clear()
+    emulator.commands = 0
+    eeprom.open_port(emulator)
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(0)
+    programmer.set_end(256)
+    programmer.set_input_rom(test_input)
+    programmer.set_resume(True)
+    programmer.write_eeprom()
+    assert "Resuming from address 32.\n" in result.getvalue()
+    assert emulator.commands == 2 + 14
+    with open(test_input, "rb") as rom:
+        assert emulator.memory[:256] == rom.read(256)
+    assert not os.path.exists(test_input + ".journal")
+
+def test_programmer_resume_after_first_record_failed(tmp_path):
+    journal_file = str(tmp_path / "testB.journal")
+    emulator = FakeSerial(drop_ok=[1])
+    eeprom = EEPROM()
+    eeprom.open_port(emulator)
+    eeprom.set_retry_policy(0)
+    programmer = Programmer(eeprom, StringIO())
+    programmer.set_start(0)
+    programmer.set_end(32)
+    programmer.set_input_rom("test/testB.rom")
+    programmer.set_journal_file(journal_file)
+    with pytest.raises(EEPROMTimeout):
+        programmer.write_eeprom()
+
+    emulator.drop_ok.clear()
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(0)
+    programmer.set_end(32)
+    programmer.set_input_rom("test/testB.rom")
+    programmer.set_journal_file(journal_file)
+    programmer.set_resume(True)
+    programmer.write_eeprom()
+    assert "Write journal has nothing confirmed, writing from the start.\n" in result.getvalue()
+    assert emulator.memory[:32] == b'\x42' * 32
+
+def test_programmer_resume_without_journal_writes_everything():
+    eeprom = MockEEPROM()
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(0)
+    programmer.set_end(32)
+    programmer.set_input_rom("test/testB.rom")
+    programmer.set_resume(True)
+    programmer.write_eeprom()
+    assert "No matching write journal, writing from the start.\n" in result.getvalue()
 
 def test_programmer_read_dump_0_31_bytes_file():
     test_input = "test/testA.rom"
@@ -344,6 +803,46 @@ Writing ROM test/testB.rom to EEPROM.
     print("SERIAL:", result_serial.getvalue())
     assert result_serial.getvalue() == b'W0000:42424242424242424242424242424242,00\n'
 
+def test_debug_mode_binary_write():
+    result_out = StringIO()
+    result_serial = BytesIO()
+    main(result_out, ["", "-w", "-x", "-b", "-s", "0", "-e", "16", "-p", result_serial, "test/testB.rom"])
+    assert result_out.getvalue() == """Using binary protocol.
+ROM file is 32 bytes long.
+Writing ROM test/testB.rom to EEPROM.
+"""
+    assert result_serial.getvalue() == b'V\nw\x10\x00\x00' + b'\x42' * 16 + b'\x10'
+
+def test_stats_histogram_buckets_by_power_of_two():
+    histogram = Histogram()
+    for seconds in (0.0000005, 0.000003, 0.000003, 0.001):
+        histogram.add(seconds)
+    assert histogram.as_dict()["buckets_us"] == {"1": 1, "4": 2, "1024": 1}
+    assert histogram.count == 4
+
+def test_stats_instrumented_eeprom_counts_traffic():
+    stats = Stats()
+    eeprom = EEPROM()
+    eeprom.open_port(FakeSerial())
+    instrument(eeprom, stats)
+    eeprom.read_range(0, 32)
+    list(eeprom.write_records([(0, b'\x00')]))
+    report = stats.as_dict(eeprom)
+    assert report["bytes_sent"] == 2 * 6 + 42
+    assert report["bytes_received"] == 2 * 46 + 4
+    assert report["latency"]["read"]["count"] == 2
+    assert report["latency"]["encode"]["count"] == 3
+    assert report["retries"] == 0
+
+def test_debug_mode_dump_stats_json():
+    result_out = StringIO()
+    main(result_out, ["", "-x", "-s", "0", "-e", "32", "-d", "--stats-json", "-p", BytesIO(), "/tmp/foo"])
+    output = result_out.getvalue()
+    report = json.loads(output[output.index("{"):])
+    assert report["latency"]["read"]["count"] == 2
+    assert report["baudrate"] == 9600
+    assert "file_io" in report["phases_secs"]
+
 def test_debug_mode_dump():
     result_out = StringIO()
     result_serial = BytesIO()
@@ -355,4 +854,560 @@ Dumping to file.
 bytes written:16
 """
     print("SERIAL:", result_serial.getvalue())
-    assert result_serial.getvalue() == b'R0000\n'
\ No newline at end of file
+    assert result_serial.getvalue() == b'R0000\n'
+def gang_setup(port, log):
+    eeprom = EEPROM()
+    eeprom.open_port(port)
+    programmer = Programmer(eeprom, log)
+    programmer.set_start(0)
+    programmer.set_end(32)
+    programmer.set_verify(True)
+    programmer.set_input_rom("test/testB.rom")
+    return programmer
+
+def test_gang_program_reports_each_device():
+    good = StatefulSerial(name="good")
+    silent = MockSerial()
+    silent.name = "silent"
+    results = gang_program([good, silent], gang_setup, lambda programmer: programmer.write_eeprom())
+    assert [(result.port, result.passed) for result in results] == [("good", True), ("silent", False)]
+    assert results[1].error == "Didn't receive OK back from programmer."
+    os.remove("test/testB.rom.journal")
+    assert good.memory[:32] == b'\x42' * 32
+
+def test_main_gang_mode_needs_write_or_verify():
+    result = StringIO()
+    with pytest.raises(SystemExit):
+        main(result, ["", "-p", "a", "-p", "b"])
+    assert result.getvalue() == "Gang mode needs -w or -v.\n" + usage_string
+
+def test_main_gang_mode_debug_write(tmp_path):
+    result = StringIO()
+    ports = [str(tmp_path / "a"), str(tmp_path / "b")]
+    main(result, ["", "-w", "-x", "-s", "0", "-e", "16", "-p", ports[0], "-p", ports[1], "test/testB.rom"])
+    lines = result.getvalue().splitlines()
+    assert lines[0] == "Gang programming 2 devices."
+    assert lines[2].startswith(ports[0] + ": PASS in ")
+    assert lines[3:5] == ["\tROM file is 32 bytes long.", "\tWriting ROM test/testB.rom to EEPROM."]
+    assert lines[5].startswith(ports[1] + ": PASS in ")
+    assert lines[8] == "2 of 2 devices passed."
+    with open(ports[0], "rb") as serial_log:
+        assert serial_log.read() == b'W0000:42424242424242424242424242424242,00\n'
+
+def test_main_gang_mode_prints_each_device_log(tmp_path):
+    result = StringIO()
+    ports = [str(tmp_path / "a"), str(tmp_path / "b")]
+    main(result, ["", "-w", "-v", "-x", "--stats", "-s", "0", "-e", "16", "-p", ports[0], "-p", ports[1], "test/testB.rom"])
+    output = result.getvalue()
+    assert output.count("\tVerify OK: 16 bytes match.\n") == 2
+    assert output.count("\tStats: ") == 2
+
+def test_main_gang_mode_writes_hex_images(tmp_path):
+    image = tmp_path / "image.hex"
+    image.write_text(intel_hex_line(0x0010, 0x00, b'\x01\x02') + intel_hex_line(0, 0x01, b''))
+    result = StringIO()
+    ports = [str(tmp_path / "a"), str(tmp_path / "b")]
+    main(result, ["", "-w", "-x", "-p", ports[0], "-p", ports[1], str(image)])
+    assert result.getvalue().splitlines()[-1] == "2 of 2 devices passed."
+    for port in ports:
+        with open(port, "rb") as serial_log:
+            assert serial_log.read() == b'W0010:0102FFFFFFFFFFFFFFFFFFFFFFFFFFFF,03\n'
+
+def test_benchmark_end_to_end_runs_every_operation():
+    results = end_to_end_benchmarks([1], [None])
+    assert [entry["name"] for entry in results] == ["read_1k_unthrottled", "write_1k_unthrottled",
+                                                    "verify_1k_unthrottled", "dump_1k_unthrottled"]
+    assert all(entry["count"] == 64 for entry in results)
+
+def test_benchmark_compares_against_baseline():
+    result = StringIO()
+    current = [{"name": "data_field", "count": 10, "seconds": 1, "us_per_op": 3.0}]
+    baseline = [{"name": "data_field", "count": 10, "seconds": 1, "us_per_op": 2.0}]
+    print_results(current, result, baseline)
+    assert result.getvalue().split() == ["data_field", "3.00", "us/op", "(+50.0%)"]
+
+def intel_hex_line(address, kind, data):
+    record = bytes([len(data), address >> 8, address & 0xff, kind]) + data
+    return ":" + (record + bytes([-sum(record) & 0xff])).hex().upper() + "\n"
+
+def srecord_line(kind, address, data):
+    record = bytes([len(data) + 3]) + address.to_bytes(2, 'big') + data
+    return "S" + kind + (record + bytes([~sum(record) & 0xff])).hex().upper() + "\n"
+
+def test_load_segments_reads_intel_hex(tmp_path):
+    image = tmp_path / "image.hex"
+    image.write_text(intel_hex_line(0, 0x04, b'\x00\x01') +
+                     intel_hex_line(0x0010, 0x00, b'\x01\x02') +
+                     intel_hex_line(0x0012, 0x00, b'\x03') +
+                     intel_hex_line(0x0100, 0x00, b'\x04') +
+                     intel_hex_line(0, 0x01, b''))
+    assert load_segments(str(image)) == [(0x10010, b'\x01\x02\x03'), (0x10100, b'\x04')]
+
+def test_load_segments_rejects_bad_intel_hex_checksum(tmp_path):
+    image = tmp_path / "image.hex"
+    image.write_text(intel_hex_line(0x0010, 0x00, b'\x01\x02')[:-3] + "00\n")
+    with pytest.raises(ImageFormatError):
+        load_segments(str(image))
+
+def test_load_segments_reads_srecords(tmp_path):
+    image = tmp_path / "image.s19"
+    image.write_text(srecord_line("0", 0, b'hdr') +
+                     srecord_line("1", 0x0020, b'\xaa\xbb') +
+                     srecord_line("1", 0x0000, b'\x11') +
+                     srecord_line("9", 0, b''))
+    assert load_segments(str(image)) == [(0x0000, b'\x11'), (0x0020, b'\xaa\xbb')]
+
+def test_programmer_writes_only_records_in_sparse_image(tmp_path):
+    image = tmp_path / "image.hex"
+    image.write_text(intel_hex_line(0x0004, 0x00, b'\x01\x02') +
+                     intel_hex_line(0x0100, 0x00, b'\x03' * 20) +
+                     intel_hex_line(0, 0x01, b''))
+    test_port = StatefulSerial()
+    test_port.memory[0x40:0x50] = b'\x00' * 16
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(0)
+    programmer.set_input_rom(str(image))
+    programmer.set_verify(True)
+
+    programmer.write_eeprom()
+    assert result.getvalue() == """ROM file holds 22 bytes in 2 segments.
+Writing ROM {} to EEPROM.
+Image has data in 3 of 18 records.
+Verify OK: 288 bytes match.
+""".format(image)
+    assert test_port.memory[0:16] == b'\xff' * 4 + b'\x01\x02' + b'\xff' * 10
+    assert test_port.memory[0x100:0x114] == b'\x03' * 20
+    assert test_port.memory[0x40:0x50] == b'\x00' * 16
+    assert test_port.commands == 3 + 18
+
+def test_programmer_diff_write_counts_only_records_in_sparse_image(tmp_path):
+    image = tmp_path / "image.hex"
+    image.write_text(intel_hex_line(0x0004, 0x00, b'\x01\x02') +
+                     intel_hex_line(0x0100, 0x00, b'\x03' * 20) +
+                     intel_hex_line(0, 0x01, b''))
+    test_port = StatefulSerial()
+    test_port.memory[0:16] = b'\xff' * 4 + b'\x01\x02' + b'\xff' * 10
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(0)
+    programmer.set_input_rom(str(image))
+    programmer.set_diff_write(True)
+
+    programmer.write_eeprom()
+    assert result.getvalue().endswith("Image has data in 3 of 18 records.\nSkipped 1 unchanged records, wrote 2.\n")
+    assert test_port.memory[0x100:0x114] == b'\x03' * 20
+
+def test_merge_ranges_aligns_and_merges():
+    ranges = parse_ranges("0x30-0x38, 0-10,0x0c-0x14") + parse_ranges("100-120")
+    assert merge_ranges(ranges, 16, 8192) == [(0, 32), (48, 64), (96, 128)]
+    with pytest.raises(ValueError):
+        merge_ranges(parse_ranges("8000-8200"), 16, 8192)
+    with pytest.raises(ValueError):
+        parse_ranges("10-5")
+
+def test_programmer_writes_and_verifies_several_ranges(tmp_path):
+    image = tmp_path / "image.rom"
+    image.write_bytes(bytes(range(128)))
+    test_port = StatefulSerial()
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_ranges([(16, 32), (80, 112)])
+    programmer.set_input_rom(str(image))
+    programmer.set_verify(True)
+
+    programmer.write_eeprom()
+    assert result.getvalue().endswith("Verify OK: 48 bytes match.\n")
+    assert test_port.memory[16:32] == bytes(range(16))
+    assert test_port.memory[32:80] == b'\xff' * 48
+    assert test_port.memory[80:112] == bytes(range(64, 96))
+    assert test_port.commands == 3 + 3
+
+def test_programmer_dumps_several_ranges_at_their_offsets(tmp_path):
+    dump = tmp_path / "dump.rom"
+    test_port = StatefulSerial()
+    test_port.memory[0:64] = bytes(range(64))
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_ranges([(0, 16), (48, 64)])
+    programmer.set_dump_file(str(dump))
+
+    programmer.read_eeprom()
+    assert "Reading EEPROM from 0 to 16\nReading EEPROM from 48 to 64\n" in result.getvalue()
+    assert dump.read_bytes() == bytes(range(16)) + b'\xff' * 32 + bytes(range(48, 64))
+
+def test_main_range_option_conflicts_with_start_end():
+    result = StringIO()
+    with pytest.raises(SystemExit):
+        main(result, ["", "-s", "0", "-e", "16", "--range", "0-16", "test/testB.rom"])
+    assert result.getvalue().startswith("Can't mix -s/-e with --range or --range-file.")
+
+def test_programmer_prints_hexdump():
+    test_port = StatefulSerial()
+    test_port.memory[0:16] = b'ABCDEFGHIJKLMNOP'
+    test_port.memory[16:32] = b'\x00' * 16
+    test_port.memory[32:48] = b'\x00' * 16
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(0)
+    programmer.set_end(64)
+    programmer.set_hexdump(True)
+
+    programmer.read_eeprom()
+    assert result.getvalue() == """Reading EEPROM from 0 to 64
+00000000  41 42 43 44 45 46 47 48  49 4a 4b 4c 4d 4e 4f 50  |ABCDEFGHIJKLMNOP|
+00000010  00 00 00 00 00 00 00 00  00 00 00 00 00 00 00 00  |................|
+*
+00000030  ff ff ff ff ff ff ff ff  ff ff ff ff ff ff ff ff  |................|
+00000040
+"""
+
+def test_programmer_dump_streams_records(tmp_path):
+    dump = tmp_path / "dump.rom"
+    test_port = StatefulSerial()
+    test_port.memory[:] = bytes(range(256)) * 32
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    eeprom.read_range = None
+    programmer = Programmer(eeprom, StringIO())
+    programmer.set_start(0)
+    programmer.set_end(8192)
+    programmer.set_dump_file(str(dump))
+
+    programmer.read_eeprom()
+    assert dump.read_bytes() == bytes(range(256)) * 32
+
+def test_daemon_job_resolves_paths_against_client_directory(tmp_path):
+    (tmp_path / "image.rom").write_bytes(bytes(range(32)))
+    (tmp_path / "ranges.txt").write_text("0-32\n")
+    test_port = FakeSerial(BytesIO())
+    eeprom = open_eeprom(test_port, parse_args(StringIO(), ["-x"]), StringIO())
+    result = StringIO()
+    daemon_job(eeprom)(["-w", "-v", "--range-file", "ranges.txt", "--verify-report", "report.json", "image.rom"],
+                       str(tmp_path), result)
+    assert result.getvalue().endswith("Verify OK: 32 bytes match.\n")
+    assert test_port.memory[0:32] == bytes(range(32))
+    assert json.loads((tmp_path / "report.json").read_text())["ranges"] == []
+
+def test_daemon_runs_queued_jobs_on_one_port(tmp_path):
+    socket_path = str(tmp_path / "eeprom.sock")
+    test_port = FakeSerial(BytesIO())
+    eeprom = open_eeprom(test_port, parse_args(StringIO(), ["-x"]), StringIO())
+    server = JobServer(socket_path, daemon_job(eeprom))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        result = StringIO()
+        assert submit(socket_path, ["-w", "-v", "-s", "0", "-e", "32", os.path.abspath("test/testB.rom")], result) == 0
+        assert result.getvalue().endswith("Verify OK: 32 bytes match.\n")
+        result = StringIO()
+        assert submit(socket_path, ["-s", "0", "-e", "16"], result) == 0
+        assert result.getvalue() == "Reading EEPROM from 0 to 16\n0000:" + data_field(test_port.memory[0:16]) + "\n"
+        result = StringIO()
+        assert submit(socket_path, ["-S", "33"], result) == -1
+        assert result.getvalue().startswith("33 is not a valid ROMSIZE")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not os.path.exists(socket_path)
+
+def test_daemon_refuses_socket_of_a_live_daemon(tmp_path):
+    socket_path = str(tmp_path / "eeprom.sock")
+    eeprom = open_eeprom(FakeSerial(BytesIO()), parse_args(StringIO(), ["-x"]), StringIO())
+    server = JobServer(socket_path, daemon_job(eeprom))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with pytest.raises(DaemonRunning):
+            JobServer(socket_path, daemon_job(eeprom))
+        result = StringIO()
+        assert submit(socket_path, ["-s", "0", "-e", "16"], result) == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_daemon_replaces_stale_socket(tmp_path):
+    socket_path = str(tmp_path / "eeprom.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+        stale.bind(socket_path)
+    server = JobServer(socket_path, None)
+    server.server_close()
+    assert not os.path.exists(socket_path)
+
+def test_client_args_drop_socket_option():
+    assert client_args(["-w", "--socket", "/tmp/s", "-v", "--socket=/tmp/s", "rom"]) == ["-w", "-v", "rom"]
+
+def test_session_reads_writes_and_verifies_images():
+    test_port = FakeSerial(BytesIO())
+    with Session(test_port) as session:
+        assert session.version() == "EEPROM EMULATOR +BIN +CRC +EXT"
+        result = session.write_image(8, bytes(range(40)), verify=True)
+        assert result.records_written == 3
+        assert result.differences == []
+        assert session.read_image(8, 48) == bytes(range(40))
+        assert session.verify(0, b'\x00' * 16) == [(0, 8), (9, 16)]
+        with pytest.raises(ValueError):
+            session.read_image(8000, 8200)
+
+def test_session_write_image_keeps_bytes_around_unaligned_data():
+    test_port = FakeSerial(BytesIO())
+    test_port.memory[0:64] = b'\x00' * 64
+    with Session(test_port) as session:
+        assert session.write_image(8, b'\x11' * 20).records_written == 2
+        assert session.write_image(36, b'\x22' * 4).records_written == 1
+    assert test_port.memory[0:64] == b'\x00' * 8 + b'\x11' * 20 + b'\x00' * 8 + b'\x22' * 4 + b'\x00' * 24
+
+def test_session_open_negotiates_binary_and_wraps_port():
+    wrapped = []
+    session = Session(FakeSerial(BytesIO()), binary=True, wrap_port=lambda port: wrapped.append(port) or port)
+    with session:
+        assert session.negotiated.name == "binary"
+        assert session.read_image(0, 4) == b'\xff' * 4
+    assert len(wrapped) == 1
+
+def test_session_waits_for_programmer_unless_told_not_to():
+    serial_log = BytesIO()
+    with Session(FakeSerial(serial_log)):
+        assert serial_log.getvalue() == b'V\n'
+    serial_log = BytesIO()
+    with Session(FakeSerial(serial_log), ready_deadline=None):
+        assert serial_log.getvalue() == b''
+
+def test_session_probes_baud_rate():
+    with Session(BaudSerial(57600), baudrate="auto") as session:
+        assert session.eeprom.baudrate == 57600
+    with pytest.raises(ValueError):
+        Session(BaudSerial(57600), baudrate="auto", ready_deadline=None)
+
+def test_session_raises_instead_of_exiting():
+    with Session(FakeSerial(BytesIO(), drop_ok=[2], timeout=0.01), retries=0) as session:
+        with pytest.raises(EEPROMTimeout):
+            session.read_image(0, 16)
+
+def crc_verify_programmer(tmp_path, test_port):
+    image = tmp_path / "image.rom"
+    image.write_bytes(bytes(range(256)) * 4)
+    test_port.memory[0:1024] = bytes(range(256)) * 4
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(0)
+    programmer.set_end(1024)
+    programmer.set_input_rom(str(image))
+    programmer.set_verify(True)
+    programmer.set_crc_verify(True)
+    return programmer, result
+
+def test_programmer_crc_verify_narrows_down_to_bad_records(tmp_path):
+    test_port = FakeSerial(BytesIO())
+    programmer, result = crc_verify_programmer(tmp_path, test_port)
+    test_port.memory[0x1f0:0x1f2] = b'\x00\x00'
+    test_port.memory[0x201] = 0
+
+    programmer.read_eeprom()
+    assert programmer.differences == [(0x1f0, 0x1f2), (0x201, 0x202)]
+    assert result.getvalue().endswith("Verify FAILED: 3 of 1024 bytes differ in 2 ranges.\n\t01F0-01F1 (2 bytes)\n\t0201-0201 (1 bytes)\n")
+    assert test_port.commands < 64
+
+def test_programmer_crc_verify_falls_back_to_readback(tmp_path):
+    test_port = FakeSerial(BytesIO())
+    test_port.VERSION = b'EEPROM WRITER\r\n'
+    programmer, result = crc_verify_programmer(tmp_path, test_port)
+
+    programmer.read_eeprom()
+    assert result.getvalue().endswith("Verify OK: 1024 bytes match.\n")
+    assert test_port.commands == 1 + 64
+
+def test_data_field_pads_short_records():
+    assert data_field(b'\x01\x02\x03') == "010203" + "FF" * 13 + ",FF"
+    assert data_field(b'\x01\x02') == "0102" + "FF" * 14 + ",03"
+
+def test_eeprom_pipelined_write_sends_commands_in_batches():
+    test_port = StatefulSerial()
+    sent = []
+    port_write = test_port.write
+    test_port.write = lambda data: sent.append(data) or port_write(data)
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    eeprom.set_window(8)
+    records = [(addr, b'\xff' * 16) for addr in range(0, 512, 16)]
+    assert [addr for addr, cmd in eeprom.write_records(records)] == list(range(0, 512, 16))
+    assert len(sent) == 7
+    assert b''.join(sent).count(b'\n') == 32
+
+def test_debug_mode_write_above_64k(tmp_path):
+    image = tmp_path / "image.rom"
+    image.write_bytes(bytes(range(256)) * 2)
+    result_out = StringIO()
+    result_serial = BytesIO()
+    main(result_out, ["", "-w", "-v", "-x", "-b", "-S", "512", "-s", str(0x7fe00), "-e", str(0x80000), "-p", result_serial, str(image)])
+    assert result_out.getvalue().startswith("Using ascii24 protocol.\n")
+    assert result_out.getvalue().endswith("Verify OK: 512 bytes match.\n")
+    assert b'\nW07FE00:000102030405060708090A0B0C0D0E0F,00\n' in result_serial.getvalue()
+    assert b'\nR07FFF0\n' in result_serial.getvalue()
+
+def test_debug_mode_crc_verify_above_64k(tmp_path):
+    image = tmp_path / "image.rom"
+    image.write_bytes(bytes(range(256)) * 2)
+    result_out = StringIO()
+    result_serial = BytesIO()
+    main(result_out, ["", "-w", "-v", "-x", "--crc-verify", "-S", "512", "-s", str(0x7fe00), "-e", str(0x80000), "-p", result_serial, str(image)])
+    assert result_out.getvalue().endswith("Verify OK: 512 bytes match.\n")
+    assert b'\nC07FE00-07FFFF\n' in result_serial.getvalue()
+    assert b'\nR07FFF0\n' not in result_serial.getvalue()
+
+def test_session_needs_extended_firmware_for_big_parts():
+    test_port = FakeSerial(BytesIO(), rom_size=131072)
+    test_port.VERSION = b'EEPROM EMULATOR +BIN\r\n'
+    with pytest.raises(EEPROMUnsupported):
+        Session(test_port, rom_size=131072).open()
+
+def test_main_reports_firmware_without_extended_addressing(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeSerial, "VERSION", b'EEPROM EMULATOR +BIN\r\n')
+    result_out = StringIO()
+    with pytest.raises(SystemExit) as excinfo:
+        main(result_out, ["", "-r", "-x", "-S", "512", "-p", BytesIO(), str(tmp_path / "image.rom")])
+    assert excinfo.value.code == -2
+    assert result_out.getvalue() == "Programmer firmware can't address more than 64K.\n"
+
+def test_programmer_blank_check_stops_at_first_programmed_byte():
+    test_port = FakeSerial(BytesIO())
+    test_port.memory[0x123] = 0x42
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    eeprom.set_window(4)
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(0)
+    programmer.set_end(8192)
+    programmer.set_blank_check(True)
+
+    programmer.read_eeprom()
+    assert result.getvalue() == "Reading EEPROM from 0 to 8192\nBlank check FAILED: 0123 holds 42.\n"
+    assert programmer.non_blank == (0x123, 0x42)
+    assert test_port.commands < 24
+    assert eeprom.read_range(0x120, 0x130)[3] == 0x42
+
+def test_programmer_skips_blank_records_on_a_blank_eeprom(tmp_path):
+    image = tmp_path / "image.rom"
+    image.write_bytes(b'\x01' * 16 + b'\xff' * 64 + b'\x02' * 8)
+    test_port = FakeSerial(BytesIO())
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(0)
+    programmer.set_end(88)
+    programmer.set_input_rom(str(image))
+    programmer.set_skip_blank(True)
+    programmer.set_verify(True)
+
+    programmer.write_eeprom()
+    assert result.getvalue() == """ROM file is 88 bytes long.
+Writing ROM {} to EEPROM.
+Blank check OK: 88 bytes are FF.
+Skipped 4 blank records.
+Verify OK: 96 bytes match.
+""".format(image)
+    assert test_port.commands == 6 + 2 + 6
+
+def test_debug_mode_blank_check():
+    result = StringIO()
+    main(result, ["", "-x", "--blank-check", "-s", "0", "-e", "64", "-p", BytesIO()])
+    assert result.getvalue().endswith("Reading EEPROM from 0 to 64\nBlank check OK: 64 bytes are FF.\n")
+
+def test_shadow_cache_round_trips_and_evicts_least_recent(tmp_path):
+    cache = ShadowCache(str(tmp_path), max_bytes=2048)
+    shadow = cache.load("port", "V1", "chip-a", 1024)
+    shadow.store(16, b'\x01' * 16)
+    shadow.store(32, b'\x02' * 16)
+    shadow.save()
+    shadow = cache.load("port", "V1", "chip-a", 1024)
+    assert shadow.valid == [(16, 48)]
+    assert shadow.known(16, 48) and not shadow.known(0, 32)
+    assert shadow.read(16, 48) == b'\x01' * 16 + b'\x02' * 16
+    assert cache.load("port", "V2", "chip-a", 1024).valid == []
+    time.sleep(0.01)
+    cache.load("port", "V1", "chip-b", 1024).save()
+    time.sleep(0.01)
+    cache.load("port", "V1", "chip-a", 1024)
+    cache.load("port", "V1", "chip-c", 1024).save()
+    assert cache.load("port", "V1", "chip-a", 1024).valid == [(16, 48)]
+    assert not os.path.exists(cache.path(cache.key("port", "V1", "chip-b"), ".img"))
+
+def test_programmer_trusted_shadow_reads_back_what_was_written(tmp_path):
+    test_port = FakeSerial(BytesIO())
+    eeprom = EEPROM()
+    eeprom.open_port(test_port)
+    shadow = ShadowCache(str(tmp_path)).load("fake", "V1", "chip", eeprom.rom_size)
+    result = StringIO()
+    programmer = Programmer(eeprom, result)
+    programmer.set_start(0)
+    programmer.set_end(32)
+    programmer.set_input_rom("test/testB.rom")
+    programmer.set_diff_write(True)
+    programmer.set_verify(True)
+    programmer.set_shadow(shadow, trust=True)
+
+    programmer.write_eeprom()
+    assert test_port.commands == 2 + 2 + 2
+    assert result.getvalue().endswith("Verify OK: 32 bytes match.\n")
+    test_port.memory[0] = 0
+    programmer.write_eeprom()
+    assert test_port.commands == 6
+    assert result.getvalue().endswith("Skipped 2 unchanged records, wrote 0.\nVerify OK: 32 bytes match.\n")
+
+def test_failed_run_invalidates_shadow(tmp_path):
+    cache = ShadowCache(str(tmp_path))
+    shadow = cache.load("fake", "V1", "chip", 8192)
+    shadow.store(0, b'\x00' * 32)
+    eeprom = EEPROM()
+    eeprom.open_port(FakeSerial(BytesIO(), drop_ok=[1], timeout=0.01))
+    eeprom.set_retry_policy(0)
+    programmer = Programmer(eeprom, StringIO())
+    programmer.set_start(0)
+    programmer.set_end(32)
+    programmer.set_shadow(shadow)
+    with pytest.raises(EEPROMTimeout):
+        run(programmer, {"reading": True})
+    assert cache.load("fake", "V1", "chip", 8192).valid == []
+
+def test_replay_reproduces_recorded_session(tmp_path):
+    transcript = str(tmp_path / "session.tx")
+    recorded = StringIO()
+    main(recorded, ["", "-w", "-v", "-x", "-P", "4", "-s", "0", "-e", "32", "--record", transcript, "-p", BytesIO(), "test/testB.rom"])
+    replayed = StringIO()
+    main(replayed, ["", "-w", "-v", "-x", "-P", "4", "-s", "0", "-e", "32", "--replay", transcript, "--replay-speed", "0", "test/testB.rom"])
+    assert replayed.getvalue() == recorded.getvalue()
+    assert replayed.getvalue().endswith("Verify OK: 32 bytes match.\n")
+    assert replay_benchmark(transcript)["name"] == "replay_session"
+
+def test_replay_keeps_reply_timing_and_checks_commands(tmp_path):
+    transcript = str(tmp_path / "slow.tx")
+    eeprom = EEPROM()
+    eeprom.open_port(RecordingPort(FakeSerial(BytesIO(), throttle=True, latency=0.05), transcript))
+    eeprom.read(0x10)
+    eeprom.close()
+
+    eeprom.open_port(ReplaySerial(transcript))
+    started = time.perf_counter()
+    eeprom.read(0x10)
+    assert time.perf_counter() - started >= 0.04
+    eeprom.open_port(ReplaySerial(transcript, speed=0))
+    started = time.perf_counter()
+    eeprom.read(0x10)
+    assert time.perf_counter() - started < 0.04
+    eeprom.open_port(ReplaySerial(transcript, speed=0))
+    with pytest.raises(TranscriptMismatch):
+        eeprom.read(0x20)